@@ -0,0 +1,329 @@
+"""Versioned JSON API for Blogly, mounted at /api/v1.
+
+Every resource has a list endpoint paginated with the same opaque cursors as
+the HTML pages (?after=, ?before=, ?limit=) and narrowed with ?fields=, and a
+single object endpoint. Users and posts are created with POST and changed
+with PATCH on the collection; both take a single object or an array of up to
+API_MAX_BATCH objects, written in one transaction with bulk statements.
+Tags can be created the same way.
+"""
+from datetime import datetime
+
+from flask import Blueprint, abort, current_app, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+from cache import invalidate
+from models import (db, default_url, read_only, authored_tag_ids, sync_posts_tags, tag_new_posts,
+                    Post, PostTag, Tag, User)
+from pagination import keyset_page
+from tag_index import tag_added
+import search
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+#fields every resource can return; 'tags' is the list of a post's tag ids
+FIELDS = {
+    'users': (User, ['id', 'first_name', 'last_name', 'image_url']),
+    'posts': (Post, ['id', 'title', 'content', 'created_at', 'user_id', 'tags']),
+    'tags': (Tag, ['id', 'name', 'post_count']),
+}
+
+#rows per INSERT statement, well under PostgreSQL's limit on bind parameters
+INSERT_CHUNK = 1000
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    return jsonify(error=error.description), error.code
+
+def _jsonable(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def _selected_fields(resource):
+    """return the fields asked for with ?fields=, all of them by default"""
+
+    _, fields = FIELDS[resource]
+    if 'fields' not in request.args:
+        return fields
+    selected = [field for field in request.args['fields'].split(',') if field]
+    unknown = set(selected) - set(fields)
+    if unknown:
+        abort(400, 'unknown fields: %s' % ', '.join(sorted(unknown)))
+    return [field for field in fields if field in selected]
+
+def _post_tag_ids(post_ids):
+    """return a post id to sorted tag ids mapping, read with one query"""
+
+    tag_ids = {post_id: [] for post_id in post_ids}
+    links = (db.session.query(PostTag.post_id, PostTag.tag_id)
+             .filter(PostTag.post_id.in_(post_ids))
+             .order_by(PostTag.post_id, PostTag.tag_id))
+    for post_id, tag_id in links:
+        tag_ids[post_id].append(tag_id)
+    return tag_ids
+
+def _serialize(resource, rows, fields):
+    objects = [{field: _jsonable(getattr(row, field)) for field in fields if field != 'tags'}
+               for row in rows]
+    if 'tags' in fields and rows:
+        tag_ids = _post_tag_ids([row.id for row in rows])
+        for row, obj in zip(rows, objects):
+            obj['tags'] = tag_ids[row.id]
+    return objects
+
+def _list(resource):
+    model, _ = FIELDS[resource]
+    fields = _selected_fields(resource)
+    #the id is always read since the cursor is built from it
+    columns = [model.id] + [getattr(model, field) for field in fields
+                            if field not in ('id', 'tags')]
+    limit = min(request.args.get('limit', current_app.config['API_PER_PAGE'], type=int),
+                current_app.config['API_MAX_PER_PAGE'])
+    if limit < 1:
+        abort(400, 'limit must be positive')
+
+    try:
+        page = keyset_page(_visible(model, db.session.query(*columns)), [model.id], limit,
+                           after=request.args.get('after'),
+                           before=request.args.get('before'))
+    except ValueError:
+        abort(400, 'malformed cursor')
+
+    return jsonify({resource: _serialize(resource, page.items, fields),
+                    'next': page.next_cursor,
+                    'prev': page.prev_cursor})
+
+def _get(resource, object_id):
+    model, _ = FIELDS[resource]
+    fields = _selected_fields(resource)
+    row = _visible(model, model.query.filter(model.id == object_id)).first_or_404()
+    return jsonify(_serialize(resource, [row], fields)[0])
+
+def _objects(required, optional=()):
+    """return the objects in the request body as a list and whether a single one was sent
+
+    aborts with 400 unless every object has the required fields and no others.
+    """
+
+    body = request.get_json(silent=True)
+    single = isinstance(body, dict)
+    objects = [body] if single else body
+    if not isinstance(objects, list) or not objects:
+        abort(400, 'expected an object or a non-empty array of objects')
+    if len(objects) > current_app.config['API_MAX_BATCH']:
+        abort(413, 'at most %d objects per request' % current_app.config['API_MAX_BATCH'])
+
+    allowed = set(required) | set(optional)
+    for number, obj in enumerate(objects):
+        if not isinstance(obj, dict):
+            abort(400, 'item %d is not an object' % number)
+        missing = set(required) - obj.keys()
+        unknown = obj.keys() - allowed
+        if missing or unknown:
+            abort(400, 'item %d: missing %s, unknown %s'
+                  % (number, sorted(missing) or 'nothing', sorted(unknown) or 'nothing'))
+    return objects, single
+
+def _require_strings(objects, fields):
+    for number, obj in enumerate(objects):
+        for field in fields:
+            if field in obj and not (isinstance(obj[field], str) and obj[field]):
+                abort(400, 'item %d: %s must be a non-empty string' % (number, field))
+
+def _tag_ids(objects):
+    """return every tag id the objects list, aborting unless each 'tags' is a list"""
+
+    for number, obj in enumerate(objects):
+        if not isinstance(obj.get('tags', []), list):
+            abort(400, 'item %d: tags must be a list of tag ids' % number)
+    return [tag_id for obj in objects for tag_id in obj.get('tags', [])]
+
+def _visible(model, query):
+    #users are hidden from the moment their deletion starts, see tasks.purge_user
+    if model is User:
+        query = query.filter(User.deleted_at.is_(None))
+    return query
+
+def _existing_ids(model, ids):
+    ids = set(ids)
+    if not ids:
+        return set()
+    query = _visible(model, db.session.query(model.id).filter(model.id.in_(ids)))
+    return {object_id for (object_id,) in query}
+
+def _require_ids(model, ids, what):
+    if not all(isinstance(object_id, int) and not isinstance(object_id, bool) for object_id in ids):
+        abort(400, '%s ids must be integers' % what)
+    missing = set(ids) - _existing_ids(model, ids)
+    if missing:
+        abort(404, 'no %s with ids %s' % (what, ', '.join(map(str, sorted(missing)))))
+
+def _bulk_insert(table, rows):
+    """insert rows with multi-row INSERT statements; returns their ids in order
+
+    PostgreSQL hands the ids back with RETURNING. Other databases have no
+    RETURNING here, so rows go in one statement each, still in one transaction.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        ids = []
+        for start in range(0, len(rows), INSERT_CHUNK):
+            chunk = rows[start:start + INSERT_CHUNK]
+            ids.extend(object_id for (object_id,) in
+                       db.session.execute(table.insert().values(chunk).returning(table.c.id)))
+        return ids
+    return [db.session.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+
+def _bulk_update(table, objects):
+    """update rows by id with one executemany per distinct set of changed fields"""
+
+    groups = {}
+    for obj in objects:
+        changes = {key: value for key, value in obj.items() if key in table.c and key != 'id'}
+        if changes:
+            groups.setdefault(tuple(sorted(changes)), []).append(dict(changes, _id=obj['id']))
+    for rows in groups.values():
+        db.session.execute(table.update().where(table.c.id == db.bindparam('_id')), rows)
+
+def _written(resource, ids, single, status=200):
+    """respond with the objects just written, in the order they were sent"""
+
+    model, fields = FIELDS[resource]
+    rows = {row.id: row for row in db.session.query(model).filter(model.id.in_(ids))}
+    objects = _serialize(resource, [rows[object_id] for object_id in ids], fields)
+    return jsonify(objects[0] if single else {resource: objects}), status
+
+@api.route('/users')
+@read_only
+def list_users():
+    return _list('users')
+
+@api.route('/users/<int:user_id>')
+@read_only
+def get_user(user_id):
+    return _get('users', user_id)
+
+@api.route('/users', methods=['POST'])
+def create_users():
+    """create one or many users"""
+
+    objects, single = _objects(['first_name', 'last_name'], ['image_url'])
+    _require_strings(objects, ['first_name', 'last_name', 'image_url'])
+    ids = _bulk_insert(User.__table__,
+                       [{'first_name': obj['first_name'],
+                         'last_name': obj['last_name'],
+                         'image_url': obj.get('image_url') or default_url}
+                        for obj in objects])
+    db.session.commit()
+    invalidate('users')
+    return _written('users', ids, single, 201)
+
+@api.route('/users', methods=['PATCH'])
+def update_users():
+    """change fields of one or many users, each identified by its id"""
+
+    objects, single = _objects(['id'], ['first_name', 'last_name', 'image_url'])
+    _require_strings(objects, ['first_name', 'last_name', 'image_url'])
+    ids = [obj['id'] for obj in objects]
+    _require_ids(User, ids, 'users')
+
+    _bulk_update(User.__table__, objects)
+    #the feeds of a renamed author's tags show the new name
+    renamed = [obj['id'] for obj in objects if 'first_name' in obj or 'last_name' in obj]
+    tag_ids = authored_tag_ids(renamed)
+    db.session.commit()
+    invalidate('users', 'timeline', *['user:%s' % user_id for user_id in ids],
+               *['tag:%s' % tag_id for tag_id in tag_ids])
+    return _written('users', ids, single)
+
+@api.route('/posts')
+@read_only
+def list_posts():
+    return _list('posts')
+
+@api.route('/posts/<int:post_id>')
+@read_only
+def get_post(post_id):
+    return _get('posts', post_id)
+
+@api.route('/posts', methods=['POST'])
+def create_posts():
+    """create one or many posts, each optionally with a list of tag ids"""
+
+    objects, single = _objects(['title', 'content', 'user_id'], ['tags'])
+    _require_strings(objects, ['title', 'content'])
+    _require_ids(User, [obj['user_id'] for obj in objects], 'users')
+    _require_ids(Tag, _tag_ids(objects), 'tags')
+
+    #created_at comes from the column default
+    ids = _bulk_insert(Post.__table__,
+                       [{'title': obj['title'], 'content': obj['content'],
+                         'user_id': obj['user_id']}
+                        for obj in objects])
+    tagged = tag_new_posts((post_id, tag_id) for post_id, obj in zip(ids, objects)
+                           for tag_id in obj.get('tags', []))
+    search.index_posts(ids)
+    db.session.commit()
+
+    invalidate('timeline',
+               *['post:%s' % post_id for post_id in ids],
+               *{'user:%s' % obj['user_id'] for obj in objects},
+               *['tag:%s' % tag_id for tag_id in tagged],
+               *(['tags'] if tagged else []))
+    return _written('posts', ids, single, 201)
+
+@api.route('/posts', methods=['PATCH'])
+def update_posts():
+    """change the title, content or tags of one or many posts, each identified by its id"""
+
+    objects, single = _objects(['id'], ['title', 'content', 'tags'])
+    _require_strings(objects, ['title', 'content'])
+    ids = [obj['id'] for obj in objects]
+    _require_ids(Post, ids, 'posts')
+    _require_ids(Tag, _tag_ids(objects), 'tags')
+
+    #tag pages list post titles, so every tag a post had or gets is touched
+    old_tags = {tag_id for (tag_id,) in
+                db.session.query(PostTag.tag_id).filter(PostTag.post_id.in_(ids)).distinct()}
+    _bulk_update(Post.__table__, objects)
+    added_tags, removed_tags = sync_posts_tags({obj['id']: obj['tags'] for obj in objects
+                                                if 'tags' in obj})
+    counted_tags = added_tags | removed_tags
+    search.index_posts(ids)
+    user_ids = {user_id for (user_id,) in
+                db.session.query(Post.user_id).filter(Post.id.in_(ids)).distinct()}
+    db.session.commit()
+
+    invalidate('timeline',
+               *['post:%s' % post_id for post_id in ids],
+               *['user:%s' % user_id for user_id in user_ids],
+               *['tag:%s' % tag_id for tag_id in old_tags | added_tags],
+               *(['tags'] if counted_tags else []))
+    return _written('posts', ids, single)
+
+@api.route('/tags')
+@read_only
+def list_tags():
+    return _list('tags')
+
+@api.route('/tags/<int:tag_id>')
+@read_only
+def get_tag(tag_id):
+    return _get('tags', tag_id)
+
+@api.route('/tags', methods=['POST'])
+def create_tags():
+    """create one or many tags"""
+
+    objects, single = _objects(['name'])
+    _require_strings(objects, ['name'])
+    names = [obj['name'] for obj in objects]
+    taken = {name for (name,) in db.session.query(Tag.name).filter(Tag.name.in_(names))}
+    if taken or len(set(names)) != len(names):
+        abort(409, 'tag names must be unique')
+
+    ids = _bulk_insert(Tag.__table__, [{'name': name, 'post_count': 0} for name in names])
+    db.session.commit()
+    invalidate('tags', 'tag_names')
+    for tag_id, name in zip(ids, names):
+        tag_added(tag_id, name)
+    return _written('tags', ids, single, 201)
@@ -1,37 +1,150 @@
 """Blogly application."""
 
-from flask import Flask, render_template, redirect, request
-from models import db, connect_db, User, Post, PostTag, Tag
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-
-connect_db(app)
-db.create_all()
-
-from flask_debugtoolbar import DebugToolbarExtension
-app.config['SECRET_KEY'] = "thisIsSecret"
-debug = DebugToolbarExtension(app)
-
-@app.route('/')
-def redirect_to_users():
-    """root route redirects to users route"""
-
-    return redirect('/users')
-
-@app.route('/users')
+import hashlib
+import os
+from datetime import datetime
+
+from flask import (Blueprint, Flask, Response, render_template, redirect, request, abort,
+                   current_app, jsonify)
+from models import (db, connect_db, read_only, authored_tag_ids, delete_posts, live_user_or_404,
+                    sync_post_tags, User, Post, PostTag, Tag)
+from pagination import keyset_page
+from cli import blogly_cli
+from config import configs
+from cache import cached_page, changed_at, init_page_cache, invalidate
+import search
+from metrics import init_metrics
+from tasks import init_tasks, purge_user, submit
+from tag_index import complete_tags, init_tag_index, tag_added
+from api import api
+import avatars
+import queries
+
+blogly = Blueprint('blogly', __name__)
+
+def create_app(config=None):
+    """build a Blogly application for a profile name or a config object
+
+    without an argument the profile is read from the BLOGLY_CONFIG
+    environment variable and defaults to development.
+    """
+
+    if config is None:
+        config = os.environ.get('BLOGLY_CONFIG', 'development')
+    if isinstance(config, str):
+        config = configs[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    if not app.config.get('SECRET_KEY'):
+        raise RuntimeError('SECRET_KEY is not set')
+
+    connect_db(app)
+    init_page_cache(app)
+    init_metrics(app)
+    init_tasks(app)
+    init_tag_index(app)
+    avatars.init_avatars(app)
+    #the schema is managed out-of-band by `flask blogly migrate`, see migrations.py
+    app.cli.add_command(blogly_cli)
+    app.register_blueprint(blogly)
+    app.register_blueprint(api)
+
+    if app.config['DEBUG_TOOLBAR']:
+        #only development pays for importing the toolbar and rewriting every response
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    return app
+
+def submitted_tag_ids(form):
+    """return the ids of the tags chosen on a post form"""
+
+    #only chosen tags are submitted, each as a tag field holding its id
+    return {int(value) for value in form.getlist('tag') if value.isdigit()}
+
+def post_deps(post_id, user_id, tag_ids):
+    """return the cache dependencies of every page that shows a post"""
+
+    return (['timeline', 'post:%s' % post_id, 'user:%s' % user_id] +
+            ['tag:%s' % tag_id for tag_id in tag_ids])
+
+#the query arguments of the paginated pages, which are all their cache keys include
+PAGE_ARGS = ('after', 'before')
+
+#the <updated> of a feed whose change time is unknown and that has no entries; Atom requires one
+EMPTY_FEED_UPDATED = datetime(1970, 1, 1)
+
+def feed_response(title, posts, dep, author=None):
+    """render posts as an Atom feed, answering conditional requests with a 304
+
+    Last-Modified is when dep, the feed's cache dependency, was last
+    invalidated, which edits, deletions and author renames all do. When that
+    is unknown the feed is only revalidated by its ETag, a hash of the body,
+    and <updated> falls back to the newest post.
+    """
+
+    changed = changed_at(dep)
+    if changed is not None:
+        updated = changed
+    else:
+        updated = max((post.created_at for post in posts), default=EMPTY_FEED_UPDATED)
+    body = render_template('feed.xml',
+                           title=title,
+                           posts=posts,
+                           author=author,
+                           updated=updated.replace(microsecond=0))
+    response = Response(body, content_type='application/atom+xml; charset=utf-8')
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    if changed is not None:
+        response.last_modified = changed
+    return response.make_conditional(request)
+
+@blogly.route('/')
+@read_only
+@cached_page('timeline', args=PAGE_ARGS)
+def timeline():
+    """display one page of the newest posts across all users"""
+
+    #walks ix_posts_created_at newest first; the author comes along in the same query
+    try:
+        page = keyset_page(Post.query.options(db.joinedload(Post.user, innerjoin=True)),
+                           [Post.created_at, Post.id],
+                           current_app.config['TIMELINE_PER_PAGE'],
+                           after=request.args.get('after'),
+                           before=request.args.get('before'),
+                           descending=True)
+    except ValueError:
+        abort(400)
+
+    return render_template('timeline.html',
+                            title='Recent posts',
+                            posts=page.items,
+                            next_cursor=page.next_cursor,
+                            prev_cursor=page.prev_cursor)
+
+@blogly.route('/users')
+@read_only
+@cached_page('users', args=PAGE_ARGS)
 def list_users():
-    """Display a list of all the users in the database"""
+    """Display one page of the users in the database, ordered by name"""
 
-    users = User.query.order_by(User.last_name, User.first_name).all()
+    #(last_name, first_name, id) is backed by ix_users_last_first_id so each
+    #page is a single index range scan regardless of how many users exist
+    try:
+        page = queries.user_list_page(current_app.config['USERS_PER_PAGE'],
+                                      after=request.args.get('after'),
+                                      before=request.args.get('before'))
+    except ValueError:
+        abort(400)
 
     return render_template('list.html',
                             title='Users',
-                            users=users)
+                            users=page.items,
+                            next_cursor=page.next_cursor,
+                            prev_cursor=page.prev_cursor)
 
-@app.route('/users/new', methods = ['POST', 'GET'])
+@blogly.route('/users/new', methods = ['POST', 'GET'])
 def new_user():
     """display a form where a new user can be added"""
 
@@ -46,15 +159,27 @@ def new_user():
 
         db.session.add(user)
         db.session.commit()
+        invalidate('users')
 
         return redirect('/users')
 
-@app.route('/users/<user_id>')
+@blogly.route('/users/<user_id>')
+@read_only
+@cached_page('user:{user_id}', args=PAGE_ARGS)
 def user_page(user_id):
     """display the page for a single user"""
 
-    user = User.query.get_or_404(user_id)
-    posts = Post.query.filter_by(user_id=user_id).all()
+    user = queries.user_profile(user_id)
+    if user is None:
+        abort(404)
+
+    #walks ix_posts_user_id_created_at so a prolific author's page stays cheap
+    try:
+        page = queries.user_posts_page(user.id, current_app.config['USER_POSTS_PER_PAGE'],
+                                       after=request.args.get('after'),
+                                       before=request.args.get('before'))
+    except ValueError:
+        abort(400)
     edit_url = '/users/' + user_id + '/edit'
     delete_url = '/users/' + user_id + '/delete'
 
@@ -62,13 +187,37 @@ def user_page(user_id):
                             user=user,
                             edit_url=edit_url,
                             delete_url=delete_url,
-                            posts=posts)
+                            posts=page.items,
+                            next_cursor=page.next_cursor,
+                            prev_cursor=page.prev_cursor)
+
+@blogly.route('/users/<user_id>/feed.xml')
+@read_only
+@cached_page('user:{user_id}')
+def user_feed(user_id):
+    """serve a user's newest posts as an Atom feed"""
+
+    user = live_user_or_404(user_id)
+    posts = (Post.query.filter(Post.user_id == user.id)
+             .order_by(Post.created_at.desc(), Post.id.desc())
+             .limit(current_app.config['FEED_ENTRIES'])
+             .all())
+
+    return feed_response('%s %s' % (user.first_name, user.last_name), posts, 'user:%s' % user.id,
+                         author=user)
+
+@blogly.route('/avatars/<user_id>')
+@read_only
+def avatar(user_id):
+    """serve a user's image as a thumbnail kept on local disk"""
+
+    return avatars.avatar_response(user_id)
 
-@app.route('/users/<user_id>/edit', methods = ['POST', 'GET'])
+@blogly.route('/users/<user_id>/edit', methods = ['POST', 'GET'])
 def edit_user(user_id):
     """display a page where the details of a single user can be changed"""
 
-    user = User.query.get_or_404(user_id)
+    user = live_user_or_404(user_id)
 
     if request.method == 'GET':
         
@@ -81,38 +230,53 @@ def edit_user(user_id):
         try:
             request.form['save_button']
 
+            old_name = (user.first_name, user.last_name)
             user.first_name = request.form['first']
             user.last_name = request.form['last']
             user.image_url = request.form['URL'] or None
             db.session.add(user)
+            #the timeline and the feeds of the user's tags show author names
+            renamed = (user.first_name, user.last_name) != old_name
+            tag_ids = authored_tag_ids([user.id]) if renamed else []
             db.session.commit()
+            invalidate('users', 'user:%s' % user.id, 'timeline',
+                       *['tag:%s' % tag_id for tag_id in tag_ids])
             return redirect('/users')
         except Exception:
             return redirect('/users')
 
-@app.route('/users/<user_id>/delete')
+@blogly.route('/users/<user_id>/delete')
 def delete_user(user_id):
     """delete a user based off their ID then display the users page"""
 
-    user = User.query.get_or_404(user_id)
-    db.session.delete(user)
-    db.session.commit()
+    user = live_user_or_404(user_id)
+
+    #a prolific user is deleted in the background so the request returns
+    #right away; everyone else is gone before the redirect
+    batch_size = current_app.config['DELETE_BATCH_SIZE']
+    posts = db.session.query(Post.id).filter(Post.user_id == user.id).limit(batch_size + 1)
+    if len(posts.all()) > batch_size:
+        #hidden before the purge starts; `flask blogly purge` finishes it if the worker dies
+        user.deleted_at = datetime.utcnow()
+        db.session.commit()
+        invalidate('users', 'user:%s' % user.id)
+        submit(purge_user, user.id, batch_size)
+    else:
+        purge_user(user.id, batch_size)
     return redirect('/users')
 
-@app.route('/users/<user_id>/posts/new', methods = ['POST', 'GET'])
+@blogly.route('/users/<user_id>/posts/new', methods = ['POST', 'GET'])
 def new_post(user_id):
     """display a form for adding a new post and on Post handle the form"""
 
-    user = User.query.get_or_404(user_id)
+    user = live_user_or_404(user_id)
 
     if request.method == 'GET':
 
         return_url = "/users/" + user_id + "/posts/new"
-        tags = Tag.query.order_by(Tag.name).all()
         return render_template('add_post.html',
                                 user=user,
-                                return_url=return_url,
-                                tags=tags)
+                                return_url=return_url)
     else:
         try:
             request.form['save_button']
@@ -123,46 +287,29 @@ def new_post(user_id):
                 user_id=user_id
             )
             db.session.add(post)
+            #flush so the post has an id before it is linked to its tags
+            db.session.flush()
 
-            tag_array_of_tuples = db.session.query(Tag.id).all()
-
-            for tag_tuple in tag_array_of_tuples:
-
-                number = str(tag_tuple[0])
-
-                try:
-                    #if a tag is checked then there is no error
-                    # and it is added to the PostTag database
-                    request.form[number]
-                    tagged = PostTag(
-                        post_id=post.id,
-                        tag_id=number
-                    )
-                    db.session.add(tagged)
-                except Exception:
-                    pass
-
+            added, _ = sync_post_tags(post.id, submitted_tag_ids(request.form))
+            search.index_posts([post.id])
             db.session.commit()
+            #the tag list shows post counts
+            invalidate(*post_deps(post.id, user.id, added), *(['tags'] if added else []))
 
             return redirect('/users')
         except Exception:
 
             return redirect('/users')
 
-@app.route('/posts/<post_id>', methods = ['POST', 'GET'])
+@blogly.route('/posts/<post_id>', methods = ['POST', 'GET'])
+@read_only
+@cached_page('post:{post_id}')
 def post(post_id):
     """display a post along with options to interact with the post"""
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(db.selectinload(Post.tags)).get_or_404(post_id)
     return_url = '/posts/' + post_id
     if request.method == 'GET':
-        #get an array of tuples for all the tags on this post
-        tag_array_of_tuples = db.session.query(PostTag.tag_id).filter_by(post_id=post_id).all()
-        
-        tags = []
-
-        for tag_tuple in tag_array_of_tuples:
-            tag_id = str(tag_tuple[0])
-            tags.append(Tag.query.get_or_404(tag_id))
+        tags = post.tags
 
         return render_template('post.html',
                                 post=post,
@@ -187,40 +334,18 @@ def post(post_id):
                 except Exception:
                     return redirect(return_url)
 
-@app.route('/posts/<post_id>/edit', methods = ['POST', 'GET'])
+@blogly.route('/posts/<post_id>/edit', methods = ['POST', 'GET'])
 def edit_post(post_id):
     """display the page to edit a post then process the edit or cancel"""
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(db.selectinload(Post.tags)).get_or_404(post_id)
 
     if request.method == 'GET':
-        #get the post and tag relationships for the given post
-        tag_array_of_tuples = db.session.query(PostTag.tag_id).filter_by(post_id=post_id).all()
-
-        checked_tags = []
-
-        #convert the list of tuples into a list of tags associated with the given post 
-        for tag_tuple in tag_array_of_tuples:
-            tag_id = str(tag_tuple[0])
-            checked_tags.append(Tag.query.get_or_404(tag_id))
-        
-        tags = Tag.query.order_by(Tag.id).all()
-
-        #loop through the list of existing tags and delete the ones that are already
-        #associated with the given post
-        i = 0
-        while i < len(tags):
-            tag = tags[i]
-            if tag in checked_tags:
-                del tags[i]
-            else:
-                i = i + 1
-
+        #other tags are found through /tags/autocomplete
         return_url = "/posts/" + post_id + "/edit"
         return render_template('edit_post.html',
                                 post=post,
                                 return_url=return_url,
-                                tags=tags,
-                                checked_tags=checked_tags)
+                                checked_tags=post.tags)
     else:
         view_post = '/posts/' + post_id
         try:
@@ -230,72 +355,95 @@ def edit_post(post_id):
             post.content = request.form['content']
             db.session.add(post)
 
-            tag_array_of_tuples = db.session.query(Tag.id).all()
-            #loop through every existing tag
-            for tag_tuple in tag_array_of_tuples:
-
-                number = str(tag_tuple[0])
-                try:
-                    request.form[number]
-
-                    #if the relationship between this tag and this post does not exist already
-                    if not PostTag.query.filter_by(post_id=post_id, tag_id=number).one_or_none():
+            old_tag_ids = {tag.id for tag in post.tags}
 
-                        tagged = PostTag(
-                            post_id=post_id,
-                            tag_id=number
-                        )
-                        #add the tag relationship to the PostTag database
-                        db.session.add(tagged)
-                except Exception:
-                    #exception is triggered if a tag is not checked
-                    try:
-                        #if tag and post relationship already exists in the PostTag database
-                        if PostTag.query.filter_by(post_id=post_id, tag_id=number).one_or_none():
-
-                            relationship = PostTag.query.filter_by(post_id=post_id, tag_id=number).one_or_none()
-                            #delete the relationship
-                            db.session.delete(relationship)
-                    except Exception:
-                        pass
+            #only the tags whose state changed are written
+            added, removed = sync_post_tags(post.id, submitted_tag_ids(request.form))
+            db.session.flush()
+            search.index_posts([post.id])
             db.session.commit()
+            invalidate(*post_deps(post.id, post.user_id, old_tag_ids | added),
+                       *(['tags'] if added or removed else []))
 
             return redirect(view_post)
         except Exception:
             return redirect(view_post)
 
-@app.route('/posts/<post_id>/delete', methods = ['GET', 'POST'])
+@blogly.route('/posts/<post_id>/delete', methods = ['GET', 'POST'])
 def delete_post(post_id):
     """delete a post then redirect to the users list"""
     post = Post.query.get_or_404(post_id)
-    db.session.delete(post)
+
+    tag_ids = delete_posts([post.id])
+    deps = post_deps(post.id, post.user_id, tag_ids) + (['tags'] if tag_ids else [])
+
+    search.remove_posts([post.id])
     db.session.commit()
+    invalidate(*deps)
     return redirect('/users')
 
-@app.route('/tags')
+@blogly.route('/tags')
+@read_only
+@cached_page('tags')
 def display_tags():
     """display a list of all the tags in the tags table"""
 
-    tags = Tag.query.order_by(Tag.name).all()
-
     return render_template('tag_list.html',
                             title='Tags',
-                            tags=tags)
+                            tags=queries.tag_list())
 
-@app.route('/tags/<tag_id>')
+@blogly.route('/tags/<tag_id>')
+@read_only
+@cached_page('tag:{tag_id}', args=PAGE_ARGS)
 def display_single_tag(tag_id):
-    """display a single tag and it's associated posts"""
+    """display a single tag and one page of it's associated posts, newest first"""
 
     tag = Tag.query.get_or_404(tag_id)
 
-    postTagsNotTheTable = PostTag.query.filter_by(tag_id=tag_id).all()
+    #walks ix_post_tags_tag_id_post_id so a page costs the same for any tag size
+    posts = Post.query.join(PostTag, PostTag.post_id == Post.id).filter(PostTag.tag_id == tag.id)
+    try:
+        page = keyset_page(posts, [Post.id],
+                           current_app.config['TAG_POSTS_PER_PAGE'],
+                           after=request.args.get('after'),
+                           before=request.args.get('before'),
+                           descending=True)
+    except ValueError:
+        abort(400)
 
     return render_template('tag.html',
                             title=tag.name,
                             tag=tag,
-                            )
+                            posts=page.items,
+                            next_cursor=page.next_cursor,
+                            prev_cursor=page.prev_cursor)
+
+@blogly.route('/tags/<tag_id>/feed.xml')
+@read_only
+@cached_page('tag:{tag_id}')
+def tag_feed(tag_id):
+    """serve the newest posts with a tag as an Atom feed"""
+
+    tag = Tag.query.get_or_404(tag_id)
+    posts = (Post.query.join(PostTag, PostTag.post_id == Post.id)
+             .filter(PostTag.tag_id == tag.id)
+             .options(db.joinedload(Post.user, innerjoin=True))
+             .order_by(Post.id.desc())
+             .limit(current_app.config['FEED_ENTRIES'])
+             .all())
+
+    return feed_response(tag.name, posts, 'tag:%s' % tag.id)
+
+@blogly.route('/tags/autocomplete')
+@read_only
+def tag_autocomplete():
+    """return the tags whose name starts with the q query string as JSON"""
 
-@app.route('/tags/new', methods = ['GET', 'POST'])
+    tags = complete_tags(request.args.get('q', '').strip(),
+                         current_app.config['TAG_AUTOCOMPLETE_LIMIT'])
+    return jsonify(tags=[{'id': tag_id, 'name': name} for tag_id, name in tags])
+
+@blogly.route('/tags/new', methods = ['GET', 'POST'])
 def add_tag():
     """display the page to add a new tag"""
 
@@ -309,7 +457,30 @@ def add_tag():
                 name=request.form['name']
             )
             db.session.add(tag)
+            #read what the index needs before the commit expires it
+            db.session.flush()
+            tag_id, name = tag.id, tag.name
             db.session.commit()
+            invalidate('tags', 'tag_names')
+            tag_added(tag_id, name)
             return redirect('/tags')
         except Exception:
-            return redirect('/tags')
\ No newline at end of file
+            return redirect('/tags')
+
+@blogly.route('/search')
+def search_posts():
+    """display the posts whose title or content best match the q query string"""
+
+    query = request.args.get('q', '')
+    try:
+        page = search.search_posts(query,
+                                   current_app.config['SEARCH_PER_PAGE'],
+                                   after=request.args.get('after'))
+    except ValueError:
+        abort(400)
+
+    return render_template('search.html',
+                            title='Search',
+                            query=query,
+                            posts=page.items,
+                            next_cursor=page.next_cursor)
@@ -0,0 +1,320 @@
+"""Local proxy for user avatars.
+
+/avatars/<user_id> fetches a user's image_url once, turns it into a square
+thumbnail of one of AVATAR_SIZES and keeps the result in a content-addressed
+disk cache, so pages never hot-link the original. Pages link avatars with a
+?v= hash of the image URL; a request carrying the current hash is served
+straight from disk with a year long Cache-Control, and editing the URL
+changes the hash, so browsers and the cache both pick up the new image.
+
+Thumbnails are made with Pillow when it is installed. Without it the fetched
+image is stored as is, provided it is a PNG, JPEG, GIF or WebP.
+
+The fetcher is a callable taking a URL and returning the image bytes,
+raising ValueError when it cannot. It is set with AVATAR_FETCHER; fetch_url
+is used when that is None. Since image URLs come from users, fetch_url only
+follows http and https URLs, redirects included, whose host resolves to
+public addresses, and connects to the very addresses it checked so a host
+cannot resolve to a public address for the check and a private one after.
+"""
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import re
+import socket
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+
+from flask import Response, abort, current_app, request
+
+from models import db, User
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+#a year; avatar urls change whenever their content can
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+#what avatar_version returns; ?v= is used in a file name, so nothing else is accepted
+VERSION_PATTERN = re.compile('[0-9a-f]{16}')
+
+EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/gif': 'gif', 'image/webp': 'webp'}
+
+def _public_addresses(host, port):
+    """return getaddrinfo of host, raising ValueError unless every address is public"""
+
+    try:
+        addresses = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (OSError, ValueError) as error:
+        raise ValueError('could not resolve %s: %s' % (host, error))
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise ValueError('%s resolves to the non-public address %s' % (host, address))
+    return addresses
+
+def check_url(url):
+    """raise ValueError unless url is http or https on a host with only public addresses
+
+    keeps user supplied image urls from reaching the loopback interface, the
+    private network or cloud metadata endpoints.
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError('%s is not an http or https url' % url)
+    _public_addresses(parts.hostname, parts.port)
+
+def _connect_checked(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """socket.create_connection, but only to addresses that passed the public check"""
+
+    host, port = address
+    error = None
+    for *_, sockaddr in _public_addresses(host, port):
+        try:
+            return socket.create_connection((sockaddr[0], port), timeout, source_address)
+        except OSError as failed:
+            error = failed
+    raise error
+
+class _CheckedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_checked
+
+class _CheckedHTTPSConnection(http.client.HTTPSConnection):
+    #the certificate is still checked against the host name, only the socket is pinned
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_checked
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_CheckedHTTPConnection, req)
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_CheckedHTTPSConnection, req, context=self._context)
+
+class _CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """follows a redirect only to a url check_url accepts"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+def fetch_url(url):
+    """download url, following redirects; raises ValueError for anything but a small public image"""
+
+    config = current_app.config
+    limit = config['AVATAR_MAX_SOURCE_BYTES']
+    check_url(url)
+    #no proxies: a proxy would resolve the host itself, past the check
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}), _CheckedHTTPHandler,
+                                         _CheckedHTTPSHandler, _CheckedRedirectHandler)
+    try:
+        with opener.open(url, timeout=config['AVATAR_FETCH_TIMEOUT']) as response:
+            data = response.read(limit + 1)
+    except (OSError, ValueError) as error:
+        raise ValueError('could not fetch %s: %s' % (url, error))
+    if len(data) > limit:
+        raise ValueError('%s is larger than %d bytes' % (url, limit))
+    return data
+
+def _image_type(data):
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def thumbnail(data, size):
+    """return (bytes, content type) of a size x size thumbnail of an image
+
+    raises ValueError if data is not an image.
+    """
+
+    if Image is None:
+        content_type = _image_type(data)
+        if content_type is None:
+            raise ValueError('not a PNG, JPEG, GIF or WebP image')
+        return data, content_type
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.fit(image.convert('RGB'), (size, size), Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        raise ValueError('not an image: %s' % error)
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=85, optimize=True)
+    return out.getvalue(), 'image/jpeg'
+
+def avatar_version(url):
+    """return the short hash of an image url that avatar links carry as ?v="""
+
+    return hashlib.sha256((url or '').encode('utf-8')).hexdigest()[:16]
+
+class AvatarStore:
+    """content-addressed thumbnails on disk, evicted least recently used first
+
+    blobs are named after the sha256 of their bytes, so users sharing an
+    image share a file; small key files map (url version, size) to a blob.
+    reading a blob touches its mtime, which is what eviction orders by.
+
+    the size of the cache is counted as blobs are written, walking the blob
+    tree only on the first write and when the count passes max_bytes. an
+    eviction then frees down to EVICT_TO of max_bytes, so walks stay rare; it
+    also picks up the blobs other workers wrote since the last walk.
+    """
+
+    EVICT_TO = 0.9
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        #bytes of blobs on disk as of the last walk plus what this process wrote since
+        self.total = None
+
+    def _key_path(self, version, size):
+        return os.path.join(self.directory, 'keys', '%s-%d' % (version, size))
+
+    def _blob_path(self, digest, content_type):
+        return os.path.join(self.directory, 'blobs', digest[:2],
+                            '%s.%s' % (digest, EXTENSIONS[content_type]))
+
+    def _write(self, path, data):
+        #write then rename, so readers never see half a file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(descriptor, 'wb') as out:
+            out.write(data)
+        os.replace(temporary, path)
+
+    def _blobs(self):
+        """return (mtime, size, path) of every blob on disk"""
+
+        blobs = []
+        for root, _, names in os.walk(os.path.join(self.directory, 'blobs')):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, path))
+        return blobs
+
+    def get(self, version, size):
+        """return (path, digest, content type) of a cached thumbnail, or None"""
+
+        try:
+            with open(self._key_path(version, size)) as key:
+                digest, content_type = key.read().split()
+            path = self._blob_path(digest, content_type)
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return path, digest, content_type
+
+    def put(self, version, size, data, content_type):
+        """store a thumbnail and return (path, digest, content type)"""
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest, content_type)
+        if not os.path.exists(path):
+            self._write(path, data)
+            with self.lock:
+                if self.total is None:
+                    self.total = sum(size for _, size, _ in self._blobs())
+                else:
+                    self.total += len(data)
+                if self.total > self.max_bytes:
+                    self.evict()
+        self._write(self._key_path(version, size), ('%s %s' % (digest, content_type)).encode())
+        return path, digest, content_type
+
+    def evict(self):
+        """delete the least recently used blobs until the cache fits in EVICT_TO of max_bytes"""
+
+        blobs = self._blobs()
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total <= self.max_bytes * self.EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total = total
+
+def init_avatars(app):
+    """attach the avatar store to app and make avatar_version available to templates"""
+
+    directory = app.config.get('AVATAR_CACHE_DIR') or os.path.join(app.instance_path, 'avatars')
+    app.extensions['avatars'] = AvatarStore(directory, app.config['AVATAR_CACHE_MAX_BYTES'])
+    app.add_template_filter(avatar_version)
+
+def _response(cached, immutable):
+    path, digest, content_type = cached
+    with open(path, 'rb') as blob:
+        response = Response(blob.read(), content_type=content_type)
+    response.set_etag(digest)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def avatar_response(user_id):
+    """serve a user's avatar at the size given by ?size=, fetching it on the first request"""
+
+    config = current_app.config
+    store = current_app.extensions['avatars']
+    size = request.args.get('size', config['AVATAR_SIZES'][-1], type=int)
+    if size not in config['AVATAR_SIZES']:
+        abort(400)
+
+    #a link with a version is answered from disk without asking the database
+    requested = request.args.get('v')
+    if requested is not None and not VERSION_PATTERN.fullmatch(requested):
+        abort(400)
+    if requested:
+        cached = store.get(requested, size)
+        if cached is not None:
+            return _response(cached, immutable=True)
+
+    url = (db.session.query(User.image_url)
+           .filter(User.id == user_id, User.deleted_at.is_(None))
+           .scalar())
+    if not url:
+        abort(404)
+    #the fetch can take seconds; don't hold a connection from the pool through it
+    db.session.close()
+
+    version = avatar_version(url)
+    cached = store.get(version, size)
+    if cached is None:
+        try:
+            fetch = config['AVATAR_FETCHER'] or fetch_url
+            data, content_type = thumbnail(fetch(url), size)
+        except ValueError as error:
+            current_app.logger.warning('avatar of user %s unavailable: %s', user_id, error)
+            abort(404)
+        cached = store.put(version, size, data, content_type)
+
+    return _response(cached, immutable=requested == version)
@@ -0,0 +1,280 @@
+"""Seed a database with synthetic data and benchmark every Blogly route.
+
+Each route is requested through the Flask test client with the page cache
+off, timed, and its SQL statements counted with a before_cursor_execute
+hook. A route that issues more statements than its budget fails the run, so
+an N+1 loop shows up as a failure instead of a slow page in production.
+
+    python benchmark.py --users 1000 --posts 20000 --output bench.json
+    python benchmark.py --compare bench.json
+
+The JSON report can be kept between commits and passed back in with
+--compare to print the change per route. With --memory every request is also
+traced with tracemalloc and its peak allocation reported; tracing slows
+Python down, so compare timings only between runs made the same way.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import event
+
+from app import create_app
+from config import TestingConfig
+from models import db
+import migrations
+import transfer
+
+#(endpoint, method, url, form data, statement budget); urls are filled in with
+#the ids picked by run(), write routes run after every read route. /api/
+#routes send their data as a JSON body. batch routes write two objects, so
+#on SQLite, which has no RETURNING, they pay one INSERT per object
+ROUTES = [
+    ('blogly.timeline', 'GET', '/', None, 1),
+    ('blogly.list_users', 'GET', '/users', None, 1),
+    ('blogly.new_user', 'GET', '/users/new', None, 0),
+    ('blogly.user_page', 'GET', '/users/{user_id}', None, 2),
+    ('blogly.edit_user', 'GET', '/users/{user_id}/edit', None, 1),
+    ('blogly.new_post', 'GET', '/users/{user_id}/posts/new', None, 1),
+    ('blogly.post', 'GET', '/posts/{post_id}', None, 2),
+    ('blogly.edit_post', 'GET', '/posts/{post_id}/edit', None, 2),
+    ('blogly.display_tags', 'GET', '/tags', None, 1),
+    ('blogly.display_single_tag', 'GET', '/tags/{tag_id}', None, 2),
+    ('blogly.user_feed', 'GET', '/users/{user_id}/feed.xml', None, 2),
+    ('blogly.tag_feed', 'GET', '/tags/{tag_id}/feed.xml', None, 2),
+    ('blogly.add_tag', 'GET', '/tags/new', None, 0),
+    ('blogly.tag_autocomplete', 'GET', '/tags/autocomplete?q=tag1', None, 1),
+    ('blogly.search_posts', 'GET', '/search?q=benchmark', None, 1),
+    ('blogly.avatar', 'GET', '/avatars/{user_id}', None, 1),
+    ('api.list_users', 'GET', '/api/v1/users?limit=50', None, 1),
+    ('api.get_user', 'GET', '/api/v1/users/{user_id}', None, 1),
+    ('api.list_posts', 'GET', '/api/v1/posts?limit=50', None, 2),
+    ('api.get_post', 'GET', '/api/v1/posts/{post_id}', None, 2),
+    ('api.list_tags', 'GET', '/api/v1/tags?limit=50&fields=name', None, 1),
+    ('api.get_tag', 'GET', '/api/v1/tags/{tag_id}', None, 1),
+    ('blogly.post', 'POST', '/posts/{post_id}', {'edit_button': 'Edit'}, 2),
+    ('blogly.new_user', 'POST', '/users/new',
+     {'first': 'bench', 'last': 'user', 'URL': ''}, 1),
+    ('blogly.edit_user', 'POST', '/users/{user_id}/edit',
+     {'first': 'bench', 'last': 'edited', 'URL': 'https://example.com/bench.png',
+      'save_button': 'Save'}, 4),
+    ('blogly.new_post', 'POST', '/users/{user_id}/posts/new',
+     {'title': 'benchmark post', 'content': 'benchmark content', 'save_button': 'Add',
+      'tag': '{tag_id}'}, 10),
+    ('blogly.edit_post', 'POST', '/posts/{post_id}/edit',
+     {'title': 'benchmark post', 'content': 'edited content', 'edit_button': 'Edit',
+      'tag': '{tag_id}'}, 10),
+    ('blogly.add_tag', 'POST', '/tags/new', {'name': 'tag-{n}', 'add_button': 'Add'}, 1),
+    ('api.create_users', 'POST', '/api/v1/users',
+     [{'first_name': 'api', 'last_name': 'user-{n}'}] * 2, 3),
+    ('api.update_users', 'PATCH', '/api/v1/users',
+     [{'id': 1, 'last_name': 'patched'}, {'id': 2, 'first_name': 'patched'}], 5),
+    ('api.create_posts', 'POST', '/api/v1/posts',
+     [{'title': 'api post', 'content': 'api content', 'user_id': 1, 'tags': [1, 2]}] * 2, 10),
+    ('api.update_posts', 'PATCH', '/api/v1/posts',
+     [{'id': 1, 'content': 'patched content', 'tags': [1]}, {'id': 2, 'title': 'patched'}], 11),
+    ('api.create_tags', 'POST', '/api/v1/tags',
+     [{'name': 'api-tag-{n}-a'}, {'name': 'api-tag-{n}-b'}], 4),
+    ('blogly.delete_post', 'GET', '/posts/{doomed_post_id}/delete', None, 6),
+    ('blogly.delete_user', 'GET', '/users/{doomed_user_id}/delete', None, 10),
+]
+
+#a 1x1 PNG served in place of every user image, so no request leaves the machine
+AVATAR = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk'
+                          'YPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+def benchmark_config(database_url, avatar_dir):
+    """return a config class for benchmarking against database_url"""
+
+    class BenchmarkConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = database_url
+        PAGE_CACHE_ENABLED = False
+        AVATAR_CACHE_DIR = avatar_dir
+        AVATAR_FETCHER = staticmethod(lambda url: AVATAR)
+
+    return BenchmarkConfig
+
+def records(users, posts, tags, tags_per_post, seed):
+    """yield NDJSON records for a synthetic dataset in the order import_ndjson expects"""
+
+    rng = random.Random(seed)
+    for user_id in range(1, users + 1):
+        yield {'type': 'user', 'id': user_id, 'first_name': 'first%d' % user_id,
+               'last_name': 'last%d' % rng.randrange(users)}
+
+    names = ['tag%d' % tag_id for tag_id in range(1, tags + 1)]
+    for tag_id, name in enumerate(names, 1):
+        yield {'type': 'tag', 'id': tag_id, 'name': name}
+
+    for post_id in range(1, posts + 1):
+        #tag1 is on every post so its page shows the cost of a very popular tag
+        chosen = {names[0]} | set(rng.sample(names, min(tags_per_post, tags)))
+        yield {'type': 'post', 'id': post_id, 'user_id': rng.randrange(1, users + 1),
+               'title': 'post %d' % post_id,
+               'content': 'benchmark content %d %s' % (post_id, rng.random()),
+               'tags': sorted(chosen)}
+
+def seed_database(engine, users, posts, tags, tags_per_post, seed=0):
+    """fill an empty, migrated database with a synthetic dataset"""
+
+    lines = (json.dumps(record) for record in records(users, posts, tags, tags_per_post, seed))
+    return transfer.import_ndjson(engine, lines, batch_size=5000)
+
+def _fill(value, ids):
+    if isinstance(value, dict):
+        return {_fill(key, ids): _fill(item, ids) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_fill(item, ids) for item in value]
+    return value.format(**ids) if isinstance(value, str) else value
+
+def run(app, engine, iterations, users, posts, memory=False):
+    """request every route iterations times; returns the per-route results
+
+    must be called outside of an app context so that every request gets its
+    own context and session, as it would in production. with memory set the
+    results include the largest peak allocation of any request, in KiB.
+    """
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+
+    client = app.test_client()
+    results = []
+    if memory:
+        tracemalloc.start()
+    for endpoint, method, url, data, budget in ROUTES:
+        timings = []
+        counts = []
+        peaks = []
+        for n in range(iterations):
+            ids = {'user_id': 1, 'post_id': 1, 'tag_id': 1, 'n': '%s-%d' % (time.time(), n),
+                   'doomed_post_id': posts - n, 'doomed_user_id': users - n}
+            body = {'json' if url.startswith('/api/') else 'data': _fill(data, ids)}
+            del statements[:]
+            if memory:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            response = client.open(_fill(url, ids), method=method, **body)
+            timings.append((time.perf_counter() - start) * 1000)
+            if memory:
+                peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+            counts.append(len(statements))
+            if response.status_code >= 400:
+                raise RuntimeError('%s %s answered %d' % (method, url, response.status_code))
+
+        timings.sort()
+        result = {
+            'endpoint': endpoint,
+            'method': method,
+            'url': url,
+            'statements': max(counts),
+            'budget': budget,
+            'within_budget': max(counts) <= budget,
+            'mean_ms': round(sum(timings) / len(timings), 3),
+            'p50_ms': round(timings[len(timings) // 2], 3),
+            'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        }
+        if memory:
+            result['peak_kib'] = round(max(peaks) / 1024, 1)
+        results.append(result)
+    if memory:
+        tracemalloc.stop()
+    return results
+
+def uncovered_endpoints(app):
+    """return the blogly endpoints that have no benchmark entry"""
+
+    covered = {endpoint for endpoint, *_ in ROUTES}
+    return sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                  if rule.endpoint.startswith(('blogly.', 'api.')) and rule.endpoint not in covered)
+
+def benchmark(database_url, users, posts, tags, tags_per_post, iterations, seed=0, memory=False):
+    """migrate and seed database_url, then benchmark every route; returns the report"""
+
+    with tempfile.TemporaryDirectory() as avatar_dir:
+        app = create_app(benchmark_config(database_url, avatar_dir))
+        with app.app_context():
+            migrations.upgrade(db.engine)
+            start = time.perf_counter()
+            seed_database(db.engine, users, posts, tags, tags_per_post, seed)
+            seed_seconds = time.perf_counter() - start
+            engine = db.engine
+
+        routes = run(app, engine, iterations, users, posts, memory)
+
+    return {
+        'dialect': engine.dialect.name,
+        'volumes': {'users': users, 'posts': posts, 'tags': tags, 'tags_per_post': tags_per_post},
+        'iterations': iterations,
+        'seed_seconds': round(seed_seconds, 3),
+        'uncovered_endpoints': uncovered_endpoints(app),
+        'routes': routes,
+    }
+
+def compare(report, previous):
+    """return lines describing how each route changed since a previous report"""
+
+    before = {(route['method'], route['url']): route for route in previous['routes']}
+    lines = []
+    for route in report['routes']:
+        old = before.get((route['method'], route['url']))
+        if old is None:
+            continue
+        line = ('%-6s %-32s statements %3d -> %3d   p50 %8.3f -> %8.3f ms'
+                % (route['method'], route['url'], old['statements'], route['statements'],
+                   old['p50_ms'], route['p50_ms']))
+        if 'peak_kib' in old and 'peak_kib' in route:
+            line += '   peak %8.1f -> %8.1f KiB' % (old['peak_kib'], route['peak_kib'])
+        lines.append(line)
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url',
+                        help='database to seed; a fresh SQLite file is used by default')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--tags', type=int, default=500)
+    parser.add_argument('--tags-per-post', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--output', help='write the JSON report here instead of standard output')
+    parser.add_argument('--compare', help='a previous JSON report to compare against')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace each request with tracemalloc and report its peak allocation')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or 'sqlite:///' + os.path.join(directory, 'bench.db')
+        report = benchmark(database_url, args.users, args.posts, args.tags,
+                           args.tags_per_post, args.iterations, memory=args.memory)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            print('\n'.join(compare(report, json.load(previous))), file=sys.stderr)
+
+    over = [route for route in report['routes'] if not route['within_budget']]
+    for route in over:
+        print('over budget: %s %s issued %d statements, budget %d'
+              % (route['method'], route['url'], route['statements'], route['budget']),
+              file=sys.stderr)
+    for endpoint in report['uncovered_endpoints']:
+        print('no benchmark for endpoint %s' % endpoint, file=sys.stderr)
+    return 1 if over or report['uncovered_endpoints'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
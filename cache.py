@@ -0,0 +1,225 @@
+"""Rendered page cache for Blogly's read routes.
+
+Pages are cached under their path and the query arguments the view reads,
+plus the current generation of every dependency they declare (for example
+'users' or 'user:5'). Write handlers call invalidate() with the dependencies they
+touched, which bumps those generations so the old entries are simply never
+looked up again and age out of the LRU.
+
+Entries live in a small in-process LRU in front of a shared backend. The
+shared backend is anything with get/set/incr (memcached, redis, ...). When
+none is configured pages live in the LRU alone and a MemoryBackend holds
+the generations; that only suits a single worker, so production refuses to
+cache pages without a shared backend. Entries also expire after PAGE_CACHE_TTL seconds, which
+bounds how long a missed invalidation can serve a stale page.
+"""
+import hashlib
+import threading
+import time
+from urllib.parse import urlencode
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from functools import wraps
+
+from flask import Response, current_app, g, make_response, request
+
+CachedPage = namedtuple('CachedPage', ['body', 'content_type', 'etag', 'last_modified', 'expires'])
+CachedPage.__new__.__defaults__ = (None,)
+
+class LRUCache:
+    """a bounded in-process mapping that evicts the least recently used entry"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class MemoryBackend:
+    """a process-local stand-in for a shared cache server, holding generation counters"""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def incr(self, key):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + 1
+            return self.values[key]
+
+class PageCache:
+    """two tier cache of rendered pages keyed by dependency generations"""
+
+    def __init__(self, max_entries, shared=None, ttl=None):
+        self.local = LRUCache(max_entries)
+        #pages only go to a real shared backend; a MemoryBackend would keep
+        #every page of every generation, since nothing evicts from it
+        self.shared = shared
+        self.counters = shared if shared is not None else MemoryBackend()
+        self.ttl = ttl
+
+    def generation(self, dep):
+        """return the current generation of a dependency"""
+
+        return self.counters.get('gen:' + dep) or 0
+
+    def key_for(self, path, deps):
+        """return the cache key of a page at path built from the given dependencies"""
+
+        generations = ','.join('%s=%s' % (dep, self.generation(dep)) for dep in deps)
+        return 'page:%s|%s' % (path, generations)
+
+    def get(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+        if entry is not None and entry.expires is not None and entry.expires <= time.time():
+            self.local.delete(key)
+            return None
+        return entry
+
+    def set(self, key, entry):
+        if self.ttl is not None:
+            entry = entry._replace(expires=time.time() + self.ttl)
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry)
+
+    def invalidate(self, *deps):
+        now = time.time()
+        for dep in deps:
+            self.counters.incr('gen:' + dep)
+            self.counters.set('changed:' + dep, now)
+
+    def changed_since(self, deps, since):
+        """return whether any of deps was invalidated after the time since"""
+
+        return any((self.counters.get('changed:' + dep) or 0) > since for dep in deps)
+
+def init_page_cache(app):
+    """attach a page cache to app if PAGE_CACHE_ENABLED is set
+
+    raises RuntimeError when PAGE_CACHE_REQUIRE_SHARED is set but no
+    PAGE_CACHE_BACKEND is, since workers would never see each other's
+    invalidations.
+    """
+
+    if not app.config.get('PAGE_CACHE_ENABLED'):
+        return
+    backend = app.config.get('PAGE_CACHE_BACKEND')
+    if backend is None and app.config.get('PAGE_CACHE_REQUIRE_SHARED'):
+        raise RuntimeError('PAGE_CACHE_ENABLED needs a shared PAGE_CACHE_BACKEND')
+    app.extensions['page_cache'] = PageCache(app.config['PAGE_CACHE_SIZE'], backend,
+                                             app.config.get('PAGE_CACHE_TTL'))
+
+def invalidate(*deps):
+    """drop every cached page that depends on any of deps; call after committing"""
+
+    cache = current_app.extensions.get('page_cache')
+    if cache is not None and deps:
+        cache.invalidate(*deps)
+
+def generation(dep):
+    """return the current generation of dep, or None when the page cache is off
+
+    in-process caches other than pages can compare it with the generation they
+    were built at to learn that another worker invalidated dep.
+    """
+
+    cache = current_app.extensions.get('page_cache')
+    return cache.generation(dep) if cache is not None else None
+
+def changed_at(dep):
+    """return the UTC time dep was last invalidated, or None when it is not known
+
+    it is not known when the page cache is off, or when dep has not changed
+    since the generation counters were last lost.
+    """
+
+    cache = current_app.extensions.get('page_cache')
+    changed = cache.counters.get('changed:' + dep) if cache is not None else None
+    return datetime.utcfromtimestamp(changed) if changed else None
+
+def page_response(entry):
+    """build a response for a cached page, answering conditional requests with a 304"""
+
+    response = Response(entry.body, content_type=entry.content_type)
+    response.set_etag(entry.etag)
+    if entry.last_modified is not None:
+        response.last_modified = entry.last_modified
+    return response.make_conditional(request)
+
+def cached_page(*deps, args=()):
+    """cache the GET responses of a view under deps
+
+    deps are format strings filled in with the view arguments, so
+    cached_page('user:{user_id}') caches /users/5 under 'user:5'. args names
+    the query arguments the view reads; any others are left out of the key,
+    so /users?junk=1 shares the entry of /users.
+
+    with read replicas, a page read from a replica is not stored while one of
+    its deps changed within REPLICA_READ_YOUR_WRITES_SECONDS, since the
+    replica may not have the change yet; clients inside their own window
+    (see models.read_only) skip the lookup and render from the primary.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            cache = current_app.extensions.get('page_cache')
+            if cache is None or request.method != 'GET':
+                return view(**kwargs)
+
+            #/users/05 and /users/5 are the same page and share a dependency
+            values = {name: str(int(value)) if isinstance(value, str) and value.isdigit() else value
+                      for name, value in kwargs.items()}
+            page_deps = [dep.format(**values) for dep in deps]
+            query = urlencode([(name, request.args[name]) for name in args if name in request.args])
+            key = cache.key_for('%s?%s' % (request.path, query), page_deps)
+
+            replicated = bool(current_app.config.get('REPLICA_BINDS'))
+            from_replica = replicated and g.get('read_replica')
+            entry = cache.get(key) if from_replica or not replicated else None
+            if entry is None:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200 or response.direct_passthrough:
+                    return response
+                body = response.get_data()
+                entry = CachedPage(body, response.content_type,
+                                   hashlib.sha1(body).hexdigest(), response.last_modified)
+                lag = current_app.config['REPLICA_READ_YOUR_WRITES_SECONDS']
+                if not (from_replica and cache.changed_since(page_deps, time.time() - lag)):
+                    cache.set(key, entry)
+
+            return page_response(entry)
+        return wrapper
+    return decorator
@@ -0,0 +1,94 @@
+"""Command line tools for Blogly, available as `flask blogly ...`."""
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import create_engine
+
+import migrations
+import transfer
+from models import db
+from tasks import resume_purges
+
+blogly_cli = AppGroup('blogly', help='Blogly maintenance commands.')
+
+@blogly_cli.command('migrate')
+@click.option('--check', is_flag=True,
+              help='Only list pending migrations; exit with status 1 if there are any.')
+@click.option('--url', default=None,
+              help='Database URL to migrate instead of the configured one.')
+def migrate_command(check, url):
+    """bring the database schema up to the latest version"""
+
+    engine = create_engine(url) if url else db.engine
+
+    if check:
+        waiting = migrations.pending(engine)
+        for version, description in waiting:
+            click.echo('pending %d: %s' % (version, description))
+        if waiting:
+            raise SystemExit(1)
+        click.echo('schema is up to date')
+        return
+
+    applied = migrations.upgrade(engine)
+    for version, description in applied:
+        click.echo('applied %d: %s' % (version, description))
+    if not applied:
+        click.echo('schema is up to date')
+
+@blogly_cli.command('export')
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson',
+              help='NDJSON dumps everything; CSV dumps the one table named by --table.')
+@click.option('--table', type=click.Choice(sorted(transfer.TABLES)),
+              help='Table to dump as CSV.')
+@click.option('--output', type=click.File('w'), default='-',
+              help='File to write to, standard output by default.')
+@click.option('--batch-size', type=int, default=1000,
+              help='Rows fetched from the server-side cursor at a time.')
+def export_command(fmt, table, output, batch_size):
+    """stream users, tags and posts out of the database"""
+
+    if fmt == 'csv' and table is None:
+        raise click.UsageError('--table is required for CSV exports')
+
+    with db.engine.connect() as conn:
+        if fmt == 'csv':
+            written = transfer.export_csv(conn, table, output, batch_size)
+        else:
+            written = transfer.export_ndjson(conn, output, batch_size)
+    click.echo('exported %d rows' % written, err=True)
+
+@blogly_cli.command('import')
+@click.argument('source', type=click.File('r'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson',
+              help='NDJSON loads a full dump; CSV loads the one table named by --table.')
+@click.option('--table', type=click.Choice(sorted(transfer.TABLES)),
+              help='Table to load from CSV.')
+@click.option('--batch-size', type=int, default=1000,
+              help='Rows written per statement and transaction.')
+def import_command(source, fmt, table, batch_size):
+    """stream users, tags and posts into the database"""
+
+    if fmt == 'csv' and table is None:
+        raise click.UsageError('--table is required for CSV imports')
+
+    try:
+        if fmt == 'csv':
+            loaded = transfer.import_csv(db.engine, table, source, batch_size)
+        else:
+            loaded = transfer.import_ndjson(db.engine, source, batch_size)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    click.echo('imported %d rows' % loaded, err=True)
+
+@blogly_cli.command('purge')
+@click.option('--batch-size', type=int, default=None,
+              help='Posts deleted per transaction, DELETE_BATCH_SIZE by default.')
+def purge_command(batch_size):
+    """finish deleting users whose background purge was interrupted"""
+
+    user_ids = resume_purges(batch_size or current_app.config['DELETE_BATCH_SIZE'])
+    for user_id in user_ids:
+        click.echo('purged user %d' % user_id)
+    if not user_ids:
+        click.echo('no interrupted purges')
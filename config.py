@@ -0,0 +1,98 @@
+"""Configuration profiles for Blogly."""
+import os
+
+class Config:
+    """settings shared by every profile"""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///blogly')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    #read_only views read from these; writes always go to SQLALCHEMY_DATABASE_URI
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                               if uri]
+    #how long a client that wrote keeps reading from the primary
+    REPLICA_READ_YOUR_WRITES_SECONDS = 5
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'thisIsSecret')
+    DEBUG_TOOLBAR = False
+    USERS_PER_PAGE = 50
+    SEARCH_PER_PAGE = 20
+    TAG_POSTS_PER_PAGE = 20
+    USER_POSTS_PER_PAGE = 20
+    TIMELINE_PER_PAGE = 20
+    FEED_ENTRIES = 20
+    #serve tag autocompletion from an in-process index instead of the database
+    TAG_INDEX_ENABLED = True
+    TAG_AUTOCOMPLETE_LIMIT = 10
+    #how often an index looks for tags other workers created, see tag_index.py
+    TAG_INDEX_REFRESH_SECONDS = 5
+    #tags below the highest id an index has seen that it reads again, for ids that commit out of order
+    TAG_INDEX_TRAILING_IDS = 1000
+    TAG_INDEX_RELOAD_SECONDS = 600
+    API_PER_PAGE = 100
+    API_MAX_PER_PAGE = 1000
+    #objects accepted by one batch create or update request
+    API_MAX_BATCH = 5000
+    #thumbnails of user images, see avatars.py; the directory defaults to the instance folder
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR')
+    AVATAR_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    AVATAR_SIZES = (64, 128)
+    AVATAR_FETCHER = None
+    AVATAR_FETCH_TIMEOUT = 5
+    AVATAR_MAX_SOURCE_BYTES = 5 * 1024 * 1024
+    PAGE_CACHE_ENABLED = True
+    PAGE_CACHE_SIZE = 1024
+    #an object with get/set/delete/incr shared by every worker, see cache.py
+    PAGE_CACHE_BACKEND = None
+    #seconds a cached page is served before it is rendered again, whatever its generations say
+    PAGE_CACHE_TTL = 300
+    PAGE_CACHE_REQUIRE_SHARED = False
+    METRICS_ENABLED = True
+    #run background jobs inline, see tasks.py
+    TASKS_EAGER = False
+    #users with more posts than this are deleted in batches of this size in the background
+    DELETE_BATCH_SIZE = 1000
+    #statements at least this slow are sampled into the slow query log; None turns it off
+    METRICS_SLOW_QUERY_MS = None
+    METRICS_SLOW_QUERY_SAMPLE_RATE = 1.0
+
+class DevelopmentConfig(Config):
+    """local development: log every statement and install the debug toolbar"""
+
+    SQLALCHEMY_ECHO = True
+    DEBUG_TOOLBAR = True
+    PAGE_CACHE_ENABLED = False
+
+class TestingConfig(Config):
+    """test runs: a throwaway in-memory SQLite database unless told otherwise"""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+    SQLALCHEMY_REPLICA_URIS = []
+    TASKS_EAGER = True
+
+class ProductionConfig(Config):
+    """production: no statement logging, no toolbar, a tuned connection pool"""
+
+    TEMPLATES_AUTO_RELOAD = False
+    #sessions are signed with this, so it has no default; create_app refuses to start without it
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    #several workers need a shared PAGE_CACHE_BACKEND to see each other's invalidations,
+    #so the page cache stays off until one is configured
+    PAGE_CACHE_ENABLED = False
+    PAGE_CACHE_REQUIRE_SHARED = True
+    METRICS_SLOW_QUERY_MS = float(os.environ.get('METRICS_SLOW_QUERY_MS', 250))
+    METRICS_SLOW_QUERY_SAMPLE_RATE = float(os.environ.get('METRICS_SLOW_QUERY_SAMPLE_RATE', 0.1))
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        #drop connections the server or a proxy closed behind our back
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    }
+
+configs = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
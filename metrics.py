@@ -0,0 +1,182 @@
+"""Per-request performance instrumentation for Blogly.
+
+Every request records its SQL statement count, SQL time, template render
+time and total time. The numbers are sent back in a Server-Timing header
+and folded into per-endpoint histograms served in the Prometheus text
+format at /metrics. Histograms are per process; scrape every worker.
+
+Statements slower than METRICS_SLOW_QUERY_MS are sampled at
+METRICS_SLOW_QUERY_SAMPLE_RATE into a bounded list of recent slow queries
+and logged as warnings.
+"""
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+from flask import (Response, before_render_template, current_app, g, has_app_context,
+                   request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#upper bounds in seconds, the same for every histogram
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    """fixed bucket histogram of observations in seconds"""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+class RequestStats:
+    """the measurements of the request being served"""
+
+    __slots__ = ('start', 'sql_count', 'sql_time', 'template_time', 'template_start')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_start = None
+
+class Metrics:
+    """per-endpoint histograms and counters for one application"""
+
+    HISTOGRAMS = (
+        ('blogly_request_duration_seconds', 'Time spent serving requests.'),
+        ('blogly_sql_duration_seconds', 'Time spent in SQL statements per request.'),
+        ('blogly_template_duration_seconds', 'Time spent rendering templates per request.'),
+    )
+
+    def __init__(self, slow_query_ms=None, slow_query_sample_rate=1.0, slow_query_history=100):
+        self.lock = threading.Lock()
+        self.histograms = {name: {} for name, _ in self.HISTOGRAMS}
+        self.sql_statements = {}
+        self.slow_query_seconds = slow_query_ms / 1000.0 if slow_query_ms is not None else None
+        self.slow_query_sample_rate = slow_query_sample_rate
+        self.slow_queries = deque(maxlen=slow_query_history)
+
+    def record(self, endpoint, stats, total):
+        with self.lock:
+            for name, value in (('blogly_request_duration_seconds', total),
+                                ('blogly_sql_duration_seconds', stats.sql_time),
+                                ('blogly_template_duration_seconds', stats.template_time)):
+                histogram = self.histograms[name].get(endpoint)
+                if histogram is None:
+                    histogram = self.histograms[name][endpoint] = Histogram()
+                histogram.observe(value)
+            self.sql_statements[endpoint] = self.sql_statements.get(endpoint, 0) + stats.sql_count
+
+    def render(self):
+        """return every metric in the Prometheus text exposition format"""
+
+        lines = []
+        with self.lock:
+            for name, description in self.HISTOGRAMS:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s histogram' % name)
+                for endpoint, histogram in sorted(self.histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append('%s_bucket{endpoint="%s",le="%s"} %d'
+                                     % (name, endpoint, bound, cumulative))
+                    lines.append('%s_sum{endpoint="%s"} %.6f' % (name, endpoint, histogram.total))
+                    lines.append('%s_count{endpoint="%s"} %d' % (name, endpoint, histogram.count))
+
+            lines.append('# HELP blogly_sql_statements_total SQL statements issued.')
+            lines.append('# TYPE blogly_sql_statements_total counter')
+            for endpoint, count in sorted(self.sql_statements.items()):
+                lines.append('blogly_sql_statements_total{endpoint="%s"} %d' % (endpoint, count))
+        return '\n'.join(lines) + '\n'
+
+def _stats():
+    """return the measurements of the current request, or None outside of one"""
+
+    return g.get('request_stats') if has_app_context() else None
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_start'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _stats()
+    if stats is None:
+        return
+    elapsed = time.perf_counter() - conn.info['metrics_query_start']
+    stats.sql_count += 1
+    stats.sql_time += elapsed
+
+    metrics = current_app.extensions['metrics']
+    if (metrics.slow_query_seconds is not None and elapsed >= metrics.slow_query_seconds
+            and random.random() < metrics.slow_query_sample_rate):
+        metrics.slow_queries.append((request.endpoint, elapsed, statement))
+        current_app.logger.warning('slow query in %s (%.1f ms): %s',
+                                   request.endpoint, elapsed * 1000, statement)
+
+def _before_render(app, template, context, **extra):
+    stats = _stats()
+    if stats is not None:
+        stats.template_start = time.perf_counter()
+
+def _rendered(app, template, context, **extra):
+    stats = _stats()
+    if stats is not None and stats.template_start is not None:
+        stats.template_time += time.perf_counter() - stats.template_start
+        stats.template_start = None
+
+def _start_request():
+    g.request_stats = RequestStats()
+
+def _finish_request(response):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return response
+    total = time.perf_counter() - stats.start
+
+    response.headers['Server-Timing'] = (
+        'db;dur=%.3f;desc="%d queries", tpl;dur=%.3f, total;dur=%.3f'
+        % (stats.sql_time * 1000, stats.sql_count, stats.template_time * 1000, total * 1000))
+    current_app.extensions['metrics'].record(request.endpoint or 'unmatched', stats, total)
+    return response
+
+def metrics_view():
+    """serve the collected metrics to Prometheus"""
+
+    return Response(current_app.extensions['metrics'].render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+_listening = False
+
+def init_metrics(app):
+    """instrument app and serve /metrics if METRICS_ENABLED is set"""
+
+    global _listening
+
+    if not app.config.get('METRICS_ENABLED'):
+        return
+
+    app.extensions['metrics'] = Metrics(app.config.get('METRICS_SLOW_QUERY_MS'),
+                                        app.config.get('METRICS_SLOW_QUERY_SAMPLE_RATE', 1.0))
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+    if not _listening:
+        #engines are created lazily and per app, so listen on all of them and
+        #let _stats() decide whether a statement belongs to a request
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        before_render_template.connect(_before_render)
+        template_rendered.connect(_rendered)
+        _listening = True
@@ -0,0 +1,253 @@
+"""Versioned schema migrations for Blogly.
+
+Migrations run out-of-band from the web workers (see `flask blogly migrate`)
+so that booting a worker never creates or reflects the schema. Every
+migration is idempotent: it inspects the database first, so running it
+against a schema that create_all already brought up to date is a no-op.
+"""
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, ForeignKey, Integer, MetaData, String, Table, Text, inspect,
+                        select, text)
+
+from models import db
+import search
+
+MIGRATIONS = []
+
+version_metadata = MetaData()
+
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('description', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+def migration(version, description):
+    """register a function as the migration to the given schema version"""
+
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return func
+    return register
+
+def _create_index(conn, name, table, columns, unique=False):
+    """create an index unless one with that name already exists
+
+    migrations spell out their DDL instead of reusing the model definitions,
+    so that later changes to the models cannot change what an old migration does.
+    """
+
+    conn.execute(text('CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)'
+                      % ('UNIQUE ' if unique else '', name, table, ', '.join(columns))))
+
+def _has_column(conn, table, column):
+    """return whether a table already has a column"""
+
+    return column in {info['name'] for info in inspect(conn).get_columns(table)}
+
+#the tables as Blogly first created them; migration 1 builds these rather
+#than the current models, so new and upgraded databases go through the same
+#steps and end up with the same schema
+baseline_metadata = MetaData()
+
+Table('users', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('first_name', String(20), nullable=False),
+      Column('last_name', String(20), nullable=False),
+      Column('image_url', Text, nullable=False))
+
+Table('tags', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('name', Text, nullable=False, unique=True))
+
+Table('posts', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('title', Text, nullable=False),
+      Column('content', Text, nullable=False),
+      Column('created_at', DateTime),
+      Column('user_id', Integer, ForeignKey('users.id')))
+
+Table('post_tags', baseline_metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('tag_id', Integer, ForeignKey('tags.id')),
+      Column('post_id', Integer, ForeignKey('posts.id')))
+
+@migration(1, 'create the users, posts, tags and post_tags tables')
+def create_tables(conn):
+    baseline_metadata.create_all(bind=conn, checkfirst=True)
+
+@migration(2, 'index foreign keys and user names, make post_tags unique')
+def add_indexes(conn):
+    _create_index(conn, 'ix_users_last_first_id', 'users', ['last_name', 'first_name', 'id'])
+    _create_index(conn, 'ix_posts_user_id', 'posts', ['user_id'])
+    _create_index(conn, 'ix_post_tags_tag_id', 'post_tags', ['tag_id'])
+
+    #drop duplicate links left by the old per-tag insert loop before
+    #enforcing uniqueness; this index also serves lookups by post_id
+    conn.execute(text(
+        'DELETE FROM post_tags WHERE id NOT IN '
+        '(SELECT min(id) FROM post_tags GROUP BY post_id, tag_id)'))
+    _create_index(conn, 'uq_post_tags_post_id_tag_id', 'post_tags', ['post_id', 'tag_id'], unique=True)
+
+@migration(3, 'full-text search index over post titles and content')
+def add_search_index(conn):
+    search.create_index(conn)
+
+@migration(4, 'denormalized post counts on tags, (tag_id, post_id) index on post_tags')
+def add_tag_post_counts(conn):
+    if not _has_column(conn, 'tags', 'post_count'):
+        conn.execute(text('ALTER TABLE tags ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0'))
+    conn.execute(text(
+        'UPDATE tags SET post_count = '
+        '(SELECT count(*) FROM post_tags WHERE post_tags.tag_id = tags.id)'))
+
+    #lists a tag's posts in post order straight from the index; it makes the
+    #single column tag_id index redundant
+    _create_index(conn, 'ix_post_tags_tag_id_post_id', 'post_tags', ['tag_id', 'post_id'])
+    conn.execute(text('DROP INDEX IF EXISTS ix_post_tags_tag_id'))
+
+@migration(5, 'server default for posts.created_at, time ordered indexes on posts')
+def add_post_timestamps(conn):
+    conn.execute(text('UPDATE posts SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL'))
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('ALTER TABLE posts ALTER COLUMN created_at SET DEFAULT now(), '
+                          'ALTER COLUMN created_at SET NOT NULL'))
+    #SQLite cannot change a column in place; migration 9 rebuilds the table there
+
+    #the timeline and the user page walk these newest first; the user_id
+    #index makes the single column one redundant
+    _create_index(conn, 'ix_posts_user_id_created_at', 'posts', ['user_id', 'created_at', 'id'])
+    _create_index(conn, 'ix_posts_created_at', 'posts', ['created_at', 'id'])
+    conn.execute(text('DROP INDEX IF EXISTS ix_posts_user_id'))
+
+@migration(6, 'ON DELETE CASCADE on the posts and post_tags foreign keys')
+def cascade_deletes(conn):
+    if conn.dialect.name != 'postgresql':
+        #SQLite cannot alter constraints; migration 9 rebuilds its tables instead
+        return
+
+    for table, column, target in (('posts', 'user_id', 'users'),
+                                  ('post_tags', 'post_id', 'posts'),
+                                  ('post_tags', 'tag_id', 'tags')):
+        keys = [key for key in inspect(conn).get_foreign_keys(table)
+                if key['constrained_columns'] == [column]]
+        if any(key['options'].get('ondelete', '').upper() == 'CASCADE' for key in keys):
+            continue
+        for key in keys:
+            conn.execute(text('ALTER TABLE %s DROP CONSTRAINT %s' % (table, key['name'])))
+        conn.execute(text('ALTER TABLE %s ADD CONSTRAINT %s_%s_fkey FOREIGN KEY (%s) '
+                          'REFERENCES %s (id) ON DELETE CASCADE'
+                          % (table, table, column, column, target)))
+
+@migration(7, 'prefix index on lower(tags.name) for tag autocompletion')
+def add_tag_name_prefix_index(conn):
+    #text_pattern_ops lets LIKE 'prefix%' use the index whatever the collation;
+    #SQLite cannot use an index for LIKE on an expression, so it gets none
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_tags_lower_name '
+                          'ON tags (lower(name) text_pattern_ops)'))
+
+@migration(8, 'UTC server default for posts.created_at')
+def utc_post_timestamps(conn):
+    #now() is in the session time zone, while the application writes and
+    #feeds present created_at as UTC; SQLite's CURRENT_TIMESTAMP already is
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("ALTER TABLE posts ALTER COLUMN created_at "
+                          "SET DEFAULT timezone('utc', now())"))
+
+@migration(9, 'rebuild posts and post_tags on SQLite with cascading keys and a created_at default')
+def rebuild_sqlite_posts(conn):
+    #SQLite cannot change a column or a constraint in place, so migrations 5
+    #and 6 left these tables as migration 1 made them; copy them into new ones.
+    #post_tags goes through a copy without constraints: dropping posts while a
+    #table still references it would delete or refuse its rows
+    if conn.dialect.name != 'sqlite':
+        return
+    created_at = [info for info in inspect(conn).get_columns('posts') if info['name'] == 'created_at']
+    if not created_at[0]['nullable']:
+        #built from the models before migration 1 was written out
+        return
+
+    conn.execute(text('CREATE TABLE post_tags_copy AS SELECT id, tag_id, post_id FROM post_tags'))
+    conn.execute(text('DROP TABLE post_tags'))
+
+    conn.execute(text(
+        'CREATE TABLE posts_new ('
+        'id INTEGER NOT NULL, '
+        'title TEXT NOT NULL, '
+        'content TEXT NOT NULL, '
+        'created_at DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL, '
+        'user_id INTEGER, '
+        'PRIMARY KEY (id), '
+        'FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE)'))
+    conn.execute(text(
+        'INSERT INTO posts_new (id, title, content, created_at, user_id) '
+        'SELECT id, title, content, coalesce(created_at, CURRENT_TIMESTAMP), user_id FROM posts'))
+    conn.execute(text('DROP TABLE posts'))
+    conn.execute(text('ALTER TABLE posts_new RENAME TO posts'))
+
+    conn.execute(text(
+        'CREATE TABLE post_tags ('
+        'id INTEGER NOT NULL, '
+        'tag_id INTEGER, '
+        'post_id INTEGER, '
+        'PRIMARY KEY (id), '
+        'FOREIGN KEY(tag_id) REFERENCES tags (id) ON DELETE CASCADE, '
+        'FOREIGN KEY(post_id) REFERENCES posts (id) ON DELETE CASCADE)'))
+    conn.execute(text('INSERT INTO post_tags (id, tag_id, post_id) '
+                      'SELECT id, tag_id, post_id FROM post_tags_copy'))
+    conn.execute(text('DROP TABLE post_tags_copy'))
+
+    #dropping the old tables dropped their indexes
+    _create_index(conn, 'ix_posts_user_id_created_at', 'posts', ['user_id', 'created_at', 'id'])
+    _create_index(conn, 'ix_posts_created_at', 'posts', ['created_at', 'id'])
+    _create_index(conn, 'uq_post_tags_post_id_tag_id', 'post_tags', ['post_id', 'tag_id'], unique=True)
+    _create_index(conn, 'ix_post_tags_tag_id_post_id', 'post_tags', ['tag_id', 'post_id'])
+
+@migration(10, 'users.deleted_at, set while a user is being purged')
+def add_user_deleted_at(conn):
+    if not _has_column(conn, 'users', 'deleted_at'):
+        conn.execute(text('ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP'))
+
+def drop_all(engine):
+    """drop every table the migrations created; meant for throwaway test databases"""
+
+    with engine.begin() as conn:
+        search.drop_index(conn)
+        db.metadata.drop_all(bind=conn)
+        version_metadata.drop_all(bind=conn)
+
+def applied_versions(conn):
+    """return the set of migration versions already applied to a database"""
+
+    version_metadata.create_all(bind=conn, checkfirst=True)
+    return {row[0] for row in conn.execute(select(schema_version.c.version))}
+
+def pending(engine):
+    """return the (version, description) pairs not yet applied to a database"""
+
+    with engine.begin() as conn:
+        applied = applied_versions(conn)
+    return [(version, description) for version, description, _ in MIGRATIONS
+            if version not in applied]
+
+def upgrade(engine):
+    """apply every pending migration in order, each in its own transaction
+
+    returns the (version, description) pairs that were applied.
+    """
+
+    applied = []
+    for version, description, func in MIGRATIONS:
+        with engine.begin() as conn:
+            if version in applied_versions(conn):
+                continue
+            func(conn)
+            conn.execute(schema_version.insert().values(version=version,
+                                                        description=description,
+                                                        applied_at=datetime.utcnow()))
+        applied.append((version, description))
+    return applied
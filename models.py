@@ -1,45 +1,300 @@
 """Models for Blogly."""
-from flask_sqlalchemy import SQLAlchemy
+import random
+import sqlite3
+import time
+from collections import Counter
+from datetime import datetime
+from functools import wraps
 
-db = SQLAlchemy()
+from flask import current_app, g, has_app_context, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+class RoutingSession(SignallingSession):
+    """a session that sends the reads of read_only views to a replica
+
+    everything else, including every flush, goes to the primary. one replica
+    is picked per session, so a request sees a single consistent snapshot.
+    """
+
+    _replica = None
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replicas = self.app.config.get('REPLICA_BINDS')
+        if replicas and not self._flushing and has_app_context() and g.get('read_replica'):
+            if self._replica is None:
+                self._replica = random.choice(replicas)
+            return self.db.get_engine(self.app, bind=self._replica)
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _note_write(session):
+    if has_request_context():
+        g.wrote_primary = True
+
+def read_only(view):
+    """send the queries of a view's GET requests to a replica
+
+    clients that wrote within the last REPLICA_READ_YOUR_WRITES_SECONDS keep
+    reading from the primary, so the page a write redirects to shows it; the
+    page cache neither answers them nor stores replica pages of that age.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET' and time.time() >= session.get('read_primary_until', 0):
+            g.read_replica = True
+        return view(*args, **kwargs)
+    return wrapper
 
 default_url = "https://bit.ly/3y8O4Be"
 
+#SQLite's CURRENT_TIMESTAMP has no fractional seconds; storing bound values the
+#same way keeps keyset comparisons on created_at consistent there
+Timestamp = db.DateTime().with_variant(
+    sqlite.DATETIME(storage_format='%(year)04d-%(month)02d-%(day)02d '
+                                   '%(hour)02d:%(minute)02d:%(second)02d'),
+    'sqlite')
+
+class utcnow(FunctionElement):
+    """the current UTC time as a naive timestamp, the way created_at is stored and read"""
+
+    type = db.DateTime()
+    inherit_cache = True
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    #SQLite's CURRENT_TIMESTAMP is already UTC
+    return 'CURRENT_TIMESTAMP'
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    #now() is in the session time zone and would be stored as local time
+    return "timezone('utc', now())"
+
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_users_last_first_id', 'last_name', 'first_name', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     first_name = db.Column(db.String(20), nullable=False)
     last_name = db.Column(db.String(20), nullable=False)
     image_url = db.Column(db.Text, nullable=False, default=default_url)
+    #set when a background purge starts; the user is hidden from then on, see tasks.purge_user
+    deleted_at = db.Column(Timestamp)
 
 class Tag(db.Model):
     __tablename__ = 'tags'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.Text, nullable=False, unique=True)
+    #kept in step with post_tags by sync_post_tags and untag_posts
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 class Post(db.Model):
     __tablename__ = 'posts'
+    __table_args__ = (
+        db.Index('ix_posts_user_id_created_at', 'user_id', 'created_at', 'id'),
+        db.Index('ix_posts_created_at', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.Text, nullable=False)
     content = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    #stamped here as well as by the server default: SQLite databases upgraded
+    #by migration 5 have a created_at column without a default
+    created_at = db.Column(Timestamp, nullable=False, default=datetime.utcnow,
+                           server_default=utcnow())
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
+
+    user = db.relationship('User')
+
+    #read side of the post_tags association; rows are written through PostTag
+    tags = db.relationship('Tag', secondary='post_tags', viewonly=True, order_by='Tag.name')
 
 class PostTag(db.Model):
     __tablename__ = 'post_tags'
+    #the two composite indexes serve lookups by post_id and by tag_id
+    __table_args__ = (
+        db.Index('uq_post_tags_post_id_tag_id', 'post_id', 'tag_id', unique=True),
+        db.Index('ix_post_tags_tag_id_post_id', 'tag_id', 'post_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'))
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'))
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'))
+
+    #the database removes the links of a deleted post or tag; the ORM never loads them to do it
+    tag = db.relationship(Tag, backref=db.backref("post_tags", cascade="all, delete-orphan",
+                                                  passive_deletes=True))
+    post = db.relationship(Post, backref=db.backref("post_tags", cascade="all, delete-orphan",
+                                                    passive_deletes=True))
+
+def live_user_or_404(user_id):
+    """return a user, aborting with 404 if there is none or their deletion has started"""
+
+    return User.query.filter(User.id == user_id, User.deleted_at.is_(None)).first_or_404()
+
+def sync_post_tags(post_id, tag_ids):
+    """make the tags on a post match tag_ids; see sync_posts_tags"""
+
+    return sync_posts_tags({post_id: tag_ids})
+
+def sync_posts_tags(tags_by_post):
+    """make the tags on many posts match, with one bulk insert, one bulk delete and one count update
+
+    tags_by_post maps post ids to the tag ids each should have. only the
+    difference from the posts' current tags is written, and ids of tags that
+    do not exist are ignored. returns the (added, removed) sets of tag ids.
+    """
+
+    if not tags_by_post:
+        return set(), set()
 
-    tag = db.relationship(Tag, backref=db.backref("post_tags", cascade="all, delete-orphan"))
-    post = db.relationship(Post, backref=db.backref("post_tags", cascade="all, delete-orphan"))
+    wanted = {(post_id, tag_id) for post_id, tag_ids in tags_by_post.items() for tag_id in tag_ids}
+    current = {(post_id, tag_id): link_id for link_id, post_id, tag_id in
+               db.session.query(PostTag.id, PostTag.post_id, PostTag.tag_id)
+               .filter(PostTag.post_id.in_(list(tags_by_post)))}
+
+    added = wanted - current.keys()
+    removed = current.keys() - wanted
+
+    if added:
+        existing = {tag_id for (tag_id,) in
+                    db.session.query(Tag.id).filter(Tag.id.in_({tag_id for _, tag_id in added}))}
+        added = {(post_id, tag_id) for post_id, tag_id in added if tag_id in existing}
+    if added:
+        db.session.execute(PostTag.__table__.insert(),
+                           [{'post_id': post_id, 'tag_id': tag_id} for post_id, tag_id in sorted(added)])
+    if removed:
+        db.session.execute(PostTag.__table__.delete()
+                           .where(PostTag.id.in_(sorted(current[link] for link in removed))))
+
+    counts = Counter(tag_id for _, tag_id in added)
+    counts.subtract(tag_id for _, tag_id in removed)
+    changes = [{'tag_id': tag_id, 'change': change} for tag_id, change in sorted(counts.items())
+               if change]
+    if changes:
+        tags = Tag.__table__
+        db.session.execute(tags.update()
+                           .where(tags.c.id == db.bindparam('tag_id'))
+                           .values(post_count=tags.c.post_count + db.bindparam('change')),
+                           changes)
+
+    return {tag_id for _, tag_id in added}, {tag_id for _, tag_id in removed}
+
+def tag_new_posts(links):
+    """link new posts to tags with one bulk insert, keeping tag post counts in step
+
+    links are (post_id, tag_id) pairs of posts that have no tags yet. returns
+    the set of tag ids that gained posts.
+    """
+
+    links = set(links)
+    if not links:
+        return set()
+
+    db.session.execute(PostTag.__table__.insert(),
+                       [{'post_id': post_id, 'tag_id': tag_id} for post_id, tag_id in sorted(links)])
+    counts = Counter(tag_id for _, tag_id in links)
+    tags = Tag.__table__
+    db.session.execute(tags.update()
+                       .where(tags.c.id == db.bindparam('tag_id'))
+                       .values(post_count=tags.c.post_count + db.bindparam('added')),
+                       [{'tag_id': tag_id, 'added': added} for tag_id, added in counts.items()])
+    return set(counts)
+
+def untag_posts(post_ids):
+    """delete every post_tags row of the given posts, keeping tag post counts in step
+
+    returns the ids of the tags that lost posts.
+    """
+
+    post_ids = list(post_ids)
+    if not post_ids:
+        return []
+
+    counts = (db.session.query(PostTag.tag_id, db.func.count())
+              .filter(PostTag.post_id.in_(post_ids))
+              .group_by(PostTag.tag_id)
+              .all())
+    if counts:
+        tags = Tag.__table__
+        db.session.execute(tags.update()
+                           .where(tags.c.id == db.bindparam('tag_id'))
+                           .values(post_count=tags.c.post_count - db.bindparam('removed')),
+                           [{'tag_id': tag_id, 'removed': removed} for tag_id, removed in counts])
+        db.session.execute(PostTag.__table__.delete().where(PostTag.post_id.in_(post_ids)))
+
+    return [tag_id for tag_id, _ in counts]
+
+def authored_tag_ids(user_ids):
+    """return the ids of the tags on any post by the given users"""
+
+    user_ids = list(user_ids)
+    if not user_ids:
+        return []
+
+    return [tag_id for tag_id, in (db.session.query(PostTag.tag_id).distinct()
+                                   .join(Post, Post.id == PostTag.post_id)
+                                   .filter(Post.user_id.in_(user_ids)))]
+
+def delete_posts(post_ids):
+    """delete posts and their tag links with set-based statements
+
+    tag post counts are kept in step; the search index is not, see
+    search.remove_posts. returns the ids of the tags that lost posts.
+    """
+
+    post_ids = list(post_ids)
+    if not post_ids:
+        return []
+
+    tag_ids = untag_posts(post_ids)
+    db.session.execute(Post.__table__.delete().where(Post.id.in_(post_ids)))
+    return tag_ids
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    #SQLite ignores foreign keys, ON DELETE CASCADE included, unless asked per connection
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+        cursor.close()
+
+def _start_read_your_writes(response):
+    if g.get('wrote_primary'):
+        window = current_app.config['REPLICA_READ_YOUR_WRITES_SECONDS']
+        session['read_primary_until'] = time.time() + window
+    return response
 
 def connect_db(app):
-    """Connect to database."""
-    
+    """Connect to database, adding a bind for every SQLALCHEMY_REPLICA_URIS entry."""
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for number, uri in enumerate(app.config.get('SQLALCHEMY_REPLICA_URIS') or []):
+        binds['replica_%d' % number] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.config['REPLICA_BINDS'] = sorted(key for key in binds if key.startswith('replica_'))
+
     db.app = app
-    db.init_app(app)
\ No newline at end of file
+    db.init_app(app)
+
+    if app.config['REPLICA_BINDS']:
+        app.after_request(_start_read_your_writes)
\ No newline at end of file
@@ -0,0 +1,114 @@
+"""Keyset (cursor) pagination helpers for Blogly."""
+import base64
+import json
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import literal, tuple_
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+def encode_cursor(values):
+    """turn a list of sort key values into an opaque url safe cursor"""
+
+    encoded = [value.isoformat() if isinstance(value, datetime) else value
+               for value in values]
+    raw = json.dumps(encoded, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def _python_type(column):
+    #a variant describes its values through the type it wraps
+    type_ = getattr(column.type, 'impl', column.type)
+    try:
+        return type_.python_type
+    except NotImplementedError:
+        return None
+
+def decode_cursor(cursor, columns):
+    """turn a cursor back into sort key values, raising ValueError if it is malformed"""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('malformed cursor')
+
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('malformed cursor')
+
+    return [_decode_value(value, _python_type(column)) for column, value in zip(columns, values)]
+
+#the range of a 64 bit integer column; databases reject bigger values with an error
+MAX_INT = 2 ** 63
+MAX_FLOAT = sys.float_info.max
+
+def _decode_value(value, python_type):
+    """check a cursor value against the type of its column, raising ValueError if it does not fit"""
+
+    #sort keys are never NULL, and a bool is an int to isinstance
+    if value is None or isinstance(value, bool):
+        raise ValueError('malformed cursor')
+    if python_type is datetime:
+        try:
+            return datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError('malformed cursor')
+    if python_type is int:
+        if isinstance(value, int) and -MAX_INT <= value < MAX_INT:
+            return value
+    elif python_type is float:
+        #json.loads also reads Infinity and NaN
+        if isinstance(value, (int, float)) and -MAX_FLOAT <= value <= MAX_FLOAT:
+            return float(value)
+    elif python_type is str:
+        if isinstance(value, str):
+            return value
+    elif isinstance(value, (int, float, str)):
+        return value
+    raise ValueError('malformed cursor')
+
+def cursor_for(item, columns):
+    """build the cursor pointing at a single row of a page"""
+
+    return encode_cursor([getattr(item, column.key) for column in columns])
+
+def keyset_page(query, columns, per_page, after=None, before=None, descending=False):
+    """return one page of query ordered by columns, starting after or before a cursor
+
+    columns must form a unique sort key (end them with the primary key) and
+    should be backed by a composite index so that every page is an index range
+    scan no matter how deep into the table it is.
+    """
+
+    backwards = before is not None
+    cursor = before if backwards else after
+    #walking backwards through an ascending list is the same as walking
+    #forwards through a descending one, and the other way around
+    reverse_order = descending != backwards
+
+    if cursor is not None:
+        key = tuple_(*columns)
+        #bind with each column's type so values are stored-format compatible
+        values = tuple_(*[literal(value, column.type) for column, value
+                          in zip(columns, decode_cursor(cursor, columns))])
+        query = query.filter(key < values if reverse_order else key > values)
+
+    if reverse_order:
+        query = query.order_by(*[column.desc() for column in columns])
+    else:
+        query = query.order_by(*columns)
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+
+    if backwards:
+        items.reverse()
+        next_cursor = cursor_for(items[-1], columns) if items else None
+        prev_cursor = cursor_for(items[0], columns) if items and has_more else None
+    else:
+        next_cursor = cursor_for(items[-1], columns) if items and has_more else None
+        prev_cursor = cursor_for(items[0], columns) if items and after is not None else None
+
+    return Page(items, next_cursor, prev_cursor)
@@ -0,0 +1,52 @@
+"""Read-only projections for the list views.
+
+The functions here select only the columns a page prints and return them as
+small immutable namedtuples. Unlike model instances these are never added to
+the session's identity map, carry no instance state and cannot trigger lazy
+loads, so a long page costs a tuple per row. Write paths keep using the
+models.
+"""
+from collections import namedtuple
+
+from models import db, Post, Tag, User
+from pagination import keyset_page
+
+UserRow = namedtuple('UserRow', ['id', 'first_name', 'last_name'])
+UserProfile = namedtuple('UserProfile', ['id', 'first_name', 'last_name', 'image_url'])
+PostRow = namedtuple('PostRow', ['id', 'title', 'created_at'])
+TagRow = namedtuple('TagRow', ['id', 'name', 'post_count'])
+
+def _columns(model, row_type):
+    return [getattr(model, field) for field in row_type._fields]
+
+def _page(row_type, query, columns, per_page, after, before, descending=False):
+    page = keyset_page(query, columns, per_page, after=after, before=before, descending=descending)
+    return page._replace(items=[row_type._make(row) for row in page.items])
+
+def user_list_page(per_page, after=None, before=None):
+    """return a page of UserRows ordered by name; raises ValueError for a malformed cursor"""
+
+    query = db.session.query(*_columns(User, UserRow)).filter(User.deleted_at.is_(None))
+    return _page(UserRow, query, [User.last_name, User.first_name, User.id],
+                 per_page, after, before)
+
+def user_profile(user_id):
+    """return the UserProfile of a user, or None if there is no such user"""
+
+    row = (db.session.query(*_columns(User, UserProfile))
+           .filter(User.id == user_id, User.deleted_at.is_(None))
+           .first())
+    return UserProfile._make(row) if row is not None else None
+
+def user_posts_page(user_id, per_page, after=None, before=None):
+    """return a page of a user's PostRows, newest first; raises ValueError for a malformed cursor"""
+
+    query = db.session.query(*_columns(Post, PostRow)).filter(Post.user_id == user_id)
+    return _page(PostRow, query, [Post.created_at, Post.id], per_page, after, before,
+                 descending=True)
+
+def tag_list():
+    """return a TagRow for every tag, ordered by name"""
+
+    query = db.session.query(*_columns(Tag, TagRow)).order_by(Tag.name)
+    return [TagRow._make(row) for row in query]
@@ -0,0 +1,133 @@
+"""Full-text search over post titles and content.
+
+On PostgreSQL posts carry a weighted tsvector column with a GIN index; on
+SQLite (used by the tests) an FTS5 table keyed by post id plays the same
+role. Neither is maintained by triggers: the write paths call index_posts()
+and remove_posts() for the posts they touched.
+"""
+import re
+
+from sqlalchemy import Float, Integer, bindparam, literal_column, text
+
+from models import db
+from pagination import Page, decode_cursor, encode_cursor
+
+PG_VECTOR = ("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+             "setweight(to_tsvector('english', coalesce(content, '')), 'B')")
+
+#title matches count ten times as much as content matches, like the A/B weights above
+SQLITE_RANK = 'bm25(posts_fts, 10.0, 1.0)'
+
+def create_index(conn):
+    """add the search index for posts and fill it from the existing rows"""
+
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector'))
+        conn.execute(text('UPDATE posts SET search_vector = ' + PG_VECTOR))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_posts_search_vector '
+                          'ON posts USING gin (search_vector)'))
+    else:
+        conn.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(title, content)'))
+        conn.execute(text('DELETE FROM posts_fts'))
+        conn.execute(text('INSERT INTO posts_fts (rowid, title, content) '
+                          'SELECT id, title, content FROM posts'))
+
+def drop_index(conn):
+    """remove the search index"""
+
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('DROP INDEX IF EXISTS ix_posts_search_vector'))
+        conn.execute(text('ALTER TABLE posts DROP COLUMN IF EXISTS search_vector'))
+    else:
+        conn.execute(text('DROP TABLE IF EXISTS posts_fts'))
+
+def _dialect():
+    return db.engine.dialect.name
+
+def index_posts(post_ids, conn=None):
+    """bring the search index up to date for the given posts; call before committing
+
+    runs in the request's session unless a connection is given.
+    """
+
+    conn = conn if conn is not None else db.session
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+
+    if _dialect() == 'postgresql':
+        conn.execute(text('UPDATE posts SET search_vector = ' + PG_VECTOR +
+                          ' WHERE id IN :ids')
+                     .bindparams(bindparam('ids', expanding=True)),
+                     {'ids': post_ids})
+    else:
+        remove_posts(post_ids, conn)
+        conn.execute(text('INSERT INTO posts_fts (rowid, title, content) '
+                          'SELECT id, title, content FROM posts WHERE id IN :ids')
+                     .bindparams(bindparam('ids', expanding=True)),
+                     {'ids': post_ids})
+
+def remove_posts(post_ids, conn=None):
+    """drop the given posts from the search index; call before committing"""
+
+    conn = conn if conn is not None else db.session
+    post_ids = list(post_ids)
+    if post_ids and _dialect() != 'postgresql':
+        conn.execute(text('DELETE FROM posts_fts WHERE rowid IN :ids')
+                     .bindparams(bindparam('ids', expanding=True)),
+                     {'ids': post_ids})
+
+def index_unindexed_posts(conn):
+    """add every post missing from the search index, for rows loaded behind the app's back"""
+
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('UPDATE posts SET search_vector = ' + PG_VECTOR +
+                          ' WHERE search_vector IS NULL'))
+    else:
+        conn.execute(text('INSERT INTO posts_fts (rowid, title, content) '
+                          'SELECT id, title, content FROM posts '
+                          'WHERE id NOT IN (SELECT rowid FROM posts_fts)'))
+
+def search_posts(query, per_page, after=None):
+    """return a page of (id, title, rank) rows for the posts best matching query
+
+    results are ordered by relevance then id, and paginated with a cursor over
+    that same key. raises ValueError for a malformed cursor.
+    """
+
+    words = re.findall(r'\w+', query)
+    if not words:
+        return Page([], None, None)
+
+    params = {'limit': per_page + 1}
+    if _dialect() == 'postgresql':
+        #the rank is cast to float8 so it survives the round trip through a cursor exactly
+        rank = "ts_rank(p.search_vector, q)::float8"
+        sql = ("SELECT p.id, p.title, " + rank + " AS rank "
+               "FROM posts p, plainto_tsquery('english', :query) q "
+               "WHERE p.search_vector @@ q")
+        params['query'] = ' '.join(words)
+        if after is not None:
+            sql += " AND (" + rank + ", p.id) < (:rank, :id)"
+        sql += " ORDER BY rank DESC, p.id DESC LIMIT :limit"
+    else:
+        #quote every word so user input can never be read as FTS5 query syntax
+        sql = ("SELECT id, title, rank FROM ("
+               "SELECT p.id AS id, p.title AS title, " + SQLITE_RANK + " AS rank "
+               "FROM posts_fts JOIN posts p ON p.id = posts_fts.rowid "
+               "WHERE posts_fts MATCH :query) AS matches")
+        params['query'] = ' '.join('"%s"' % word for word in words)
+        if after is not None:
+            sql += " WHERE (rank, id) > (:rank, :id)"
+        sql += " ORDER BY rank, id LIMIT :limit"
+
+    if after is not None:
+        params['rank'], params['id'] = decode_cursor(
+            after, [literal_column('rank', Float), literal_column('id', Integer)])
+
+    rows = db.session.execute(text(sql), params).fetchall()
+    items = rows[:per_page]
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = encode_cursor([items[-1].rank, items[-1].id])
+    return Page(items, next_cursor, None)
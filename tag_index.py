@@ -0,0 +1,140 @@
+"""Prefix lookup over tag names for the tag autocomplete endpoint.
+
+Every worker keeps the names of all tags in a sorted list and answers a
+prefix query with a bisect and a short scan, without touching the database.
+The list is loaded from the primary on first use. After that a worker
+catches up whenever the 'tag_names' page cache generation moves (add_tag and
+the API bump it) or TAG_INDEX_REFRESH_SECONDS have passed, so workers
+without a shared page cache still learn about tags created elsewhere.
+
+Catching up reads the tags with ids above the highest seen, less
+TAG_INDEX_TRAILING_IDS: ids are handed out when a tag is inserted, not when
+it commits, so a tag can appear after one with a higher id. Every
+TAG_INDEX_RELOAD_SECONDS the whole table is read again, for a transaction
+that sat on its id for longer. Tags are never renamed or deleted, so
+reading rows is all it takes. With TAG_INDEX_ENABLED off, lookups go to the
+database instead, using the lower(name) text_pattern_ops index on PostgreSQL.
+"""
+import threading
+import time
+from bisect import bisect_left, insort
+
+from flask import current_app
+from sqlalchemy import select
+
+from cache import generation
+from models import db, Tag
+
+class TagIndex:
+    """a sorted, case-insensitive list of (name, id) pairs"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []
+        self.ids = set()
+        #the highest id read from the database
+        self.max_id = 0
+        self.generation = None
+        self.checked_at = 0
+        self.reloaded_at = 0
+        self.loaded = False
+
+    def load(self, rows, generation=None, full=False):
+        """add the rows of the tags table read from the database; full if they are all of them"""
+
+        with self.lock:
+            added = []
+            for tag_id, name in rows:
+                self.max_id = max(self.max_id, tag_id)
+                if tag_id not in self.ids:
+                    self.ids.add(tag_id)
+                    added.append((name.lower(), name, tag_id))
+            if added:
+                #a new list rather than insorts: cheap for the first load, and
+                #lookups running without the lock keep a consistent one
+                self.entries = sorted(self.entries + added)
+            self.generation = generation
+            self.checked_at = time.time()
+            if full:
+                self.reloaded_at = self.checked_at
+            self.loaded = True
+
+    def add(self, tag_id, name):
+        """add a tag created by this worker; max_id is left alone so lower ids are still read"""
+
+        with self.lock:
+            if self.loaded and tag_id not in self.ids:
+                self.ids.add(tag_id)
+                insort(self.entries, (name.lower(), name, tag_id))
+
+    def stale(self, generation, refresh_seconds):
+        """return whether tags may have been created since the index last read the database"""
+
+        return (not self.loaded or self.generation != generation
+                or time.time() - self.checked_at >= refresh_seconds)
+
+    def read_from(self, trailing_ids, reload_seconds):
+        """return the id above which the next catch up reads tags, 0 for the whole table"""
+
+        if time.time() - self.reloaded_at >= reload_seconds:
+            return 0
+        return max(self.max_id - trailing_ids, 0)
+
+    def complete(self, prefix, limit):
+        """return up to limit (id, name) pairs whose name starts with prefix, in name order"""
+
+        prefix = prefix.lower()
+        entries = self.entries
+        matches = []
+        for key, name, tag_id in entries[bisect_left(entries, (prefix,)):]:
+            if not key.startswith(prefix) or len(matches) >= limit:
+                break
+            matches.append((tag_id, name))
+        return matches
+
+def init_tag_index(app):
+    """attach a tag name index to app if TAG_INDEX_ENABLED is set"""
+
+    if app.config.get('TAG_INDEX_ENABLED'):
+        app.extensions['tag_index'] = TagIndex()
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def complete_from_database(prefix, limit):
+    """return up to limit (id, name) pairs whose name starts with prefix, read from the database"""
+
+    lower_name = db.func.lower(Tag.name)
+    rows = (db.session.query(Tag.id, Tag.name)
+            .filter(lower_name.like(_escape_like(prefix.lower()) + '%', escape='\\'))
+            .order_by(lower_name, Tag.name)
+            .limit(limit))
+    return [tuple(row) for row in rows]
+
+def complete_tags(prefix, limit):
+    """return up to limit (id, name) pairs of tags whose name starts with prefix"""
+
+    if not prefix:
+        return []
+
+    index = current_app.extensions.get('tag_index')
+    if index is None:
+        return complete_from_database(prefix, limit)
+
+    config = current_app.config
+    current = generation('tag_names')
+    if index.stale(current, config['TAG_INDEX_REFRESH_SECONDS']):
+        read_from = index.read_from(config['TAG_INDEX_TRAILING_IDS'],
+                                    config['TAG_INDEX_RELOAD_SECONDS'])
+        #straight from the primary: the view reads a replica, which may not have the new tags yet
+        with db.engine.connect() as conn:
+            index.load(conn.execute(select(Tag.id, Tag.name).where(Tag.id > read_from)),
+                       current, full=read_from == 0)
+    return index.complete(prefix, limit)
+
+def tag_added(tag_id, name):
+    """make a tag created by this worker visible to its index right away"""
+
+    index = current_app.extensions.get('tag_index')
+    if index is not None:
+        index.add(tag_id, name)
@@ -0,0 +1,110 @@
+"""Background work for Blogly.
+
+Jobs submitted with submit() run one at a time on a worker thread inside
+the application's context, each with its own database session. With
+TASKS_EAGER set (the testing profile) they run inline instead, before
+submit() returns.
+
+The queue lives in the web process, so jobs still waiting when it exits are
+lost; every job here is safe to run again from the start. A user whose purge
+was lost stays hidden through users.deleted_at, and `flask blogly purge`
+(see resume_purges) finishes the job.
+"""
+import queue
+import threading
+
+from flask import current_app
+
+from cache import invalidate
+from models import db, delete_posts, Post, User
+import search
+
+class TaskQueue:
+    """a single worker thread working through submitted jobs in order"""
+
+    def __init__(self, app):
+        self.app = app
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name='blogly-tasks', daemon=True)
+                self.thread.start()
+        self.jobs.put((func, args))
+
+    def work(self):
+        while True:
+            func, args = self.jobs.get()
+            try:
+                with self.app.app_context():
+                    func(*args)
+            except Exception:
+                self.app.logger.exception('background job %s failed', func.__name__)
+            finally:
+                self.jobs.task_done()
+
+    def join(self):
+        """wait until every submitted job has run"""
+
+        self.jobs.join()
+
+def init_tasks(app):
+    """attach a background job queue to app unless TASKS_EAGER is set"""
+
+    if not app.config.get('TASKS_EAGER'):
+        app.extensions['tasks'] = TaskQueue(app)
+
+def submit(func, *args):
+    """run func(*args) on the background worker, or right away if TASKS_EAGER is set"""
+
+    tasks = current_app.extensions.get('tasks')
+    if tasks is None:
+        func(*args)
+    else:
+        tasks.submit(func, *args)
+
+def purge_user(user_id, batch_size):
+    """delete a user's posts batch_size at a time, each batch in its own transaction, then the user
+
+    short transactions keep row locks brief and let a failed purge resume
+    where it stopped. the last batch is deleted in the same transaction as
+    the user, so tag counts and the search index never lose track of posts
+    that would otherwise go through ON DELETE CASCADE.
+    """
+
+    while True:
+        #holding the user row keeps new posts from being added to it until the batch commits
+        db.session.query(User.id).filter(User.id == user_id).with_for_update().scalar()
+        post_ids = [post_id for (post_id,) in
+                    db.session.query(Post.id)
+                    .filter(Post.user_id == user_id)
+                    .order_by(Post.id)
+                    .limit(batch_size)]
+        last = len(post_ids) < batch_size
+        tag_ids = delete_posts(post_ids)
+        search.remove_posts(post_ids)
+        if last:
+            db.session.execute(User.__table__.delete().where(User.id == user_id))
+        db.session.commit()
+        invalidate(*['post:%s' % post_id for post_id in post_ids],
+                   *['tag:%s' % tag_id for tag_id in tag_ids],
+                   *(['tags'] if tag_ids else []))
+        if last:
+            break
+
+    invalidate('users', 'timeline', 'user:%s' % user_id)
+
+def resume_purges(batch_size):
+    """finish deleting every user whose purge started but never completed
+
+    returns the ids of the users it deleted.
+    """
+
+    user_ids = [user_id for (user_id,) in
+                db.session.query(User.id).filter(User.deleted_at.isnot(None)).order_by(User.id)]
+    for user_id in user_ids:
+        purge_user(user_id, batch_size)
+    return user_ids
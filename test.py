@@ -1,21 +1,141 @@
-from unittest import TestCase
-from app import app
+import http.server
+import io
+import os
+import socket
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase, skipIf
+from app import create_app
+from config import ProductionConfig, TestingConfig
 from flask import session
-from models import db, connect_db, User, Post, PostTag, Tag
+from models import db, connect_db, sync_post_tags, User, Post, PostTag, Tag
+from sqlalchemy import event, inspect, select, text
+from cache import CachedPage, MemoryBackend, PageCache
+import benchmark
+from pagination import encode_cursor
+import migrations
+import queries
+import search
+from avatars import AvatarStore, Image, avatar_version, fetch_url, thumbnail
+from tag_index import TagIndex
+from tasks import TaskQueue
 
 class FlaskTests(TestCase):
-    
+
     def setUp(self):
-        """Initial variable declaration for set up"""
+        """Build a testing app with a migrated database and a test user, tag and post"""
 
-        self.client = app.test_client()
-        
-        app.config['TESTING'] = True
-        User.query.delete()
-        Tag.query.delete()
-        PostTag.query.delete()
-        Post.query.delete()
+        self.app = create_app('testing')
+        self.context = self.app.app_context()
+        self.context.push()
+        self.client = self.app.test_client()
+
+        migrations.upgrade(db.engine)
+
+        user = User(id=1, first_name='test', last_name='user')
+        tag = Tag(id=1, name='test')
+        db.session.add_all([user, tag])
+        db.session.commit()
+        post = Post(id=1, title='test post', content='test content', user_id=1)
+        db.session.add(post)
+        db.session.commit()
+        sync_post_tags(1, [1])
+        db.session.commit()
+
+    def tearDown(self):
+        """Throw away the session and the test schema"""
+
+        db.session.remove()
+        migrations.drop_all(db.engine)
+        self.context.pop()
+
+    def test_create_app_profiles(self):
+        """Ensure production disables echo and the toolbar and tunes the pool"""
+
+        class Production(ProductionConfig):
+            SECRET_KEY = 'test'
+
+        production = create_app(Production)
+        self.assertFalse(production.config['SQLALCHEMY_ECHO'])
+        self.assertNotIn('DEBUG_TB_ENABLED', production.config)
+        self.assertTrue(production.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_pre_ping'])
+        self.assertIn('pool_size', production.config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+        development = create_app('development')
+        self.assertTrue(development.config['SQLALCHEMY_ECHO'])
+        self.assertIn('DEBUG_TB_ENABLED', development.config)
+
+    def test_production_requires_secret_key(self):
+        """Ensure production refuses to start without a SECRET_KEY"""
+
+        class Production(ProductionConfig):
+            SECRET_KEY = None
+
+        with self.assertRaises(RuntimeError):
+            create_app(Production)
+
+    def test_migrations(self):
+        """Ensure the schema is fully migrated and upgrading again does nothing"""
+
+        self.assertEqual(migrations.pending(db.engine), [])
+        self.assertEqual(migrations.upgrade(db.engine), [])
+        index_names = {index['name'] for index in inspect(db.engine).get_indexes('post_tags')}
+        self.assertIn('uq_post_tags_post_id_tag_id', index_names)
+        self.assertIn('ix_post_tags_tag_id_post_id', index_names)
+        self.assertNotIn('ix_post_tags_tag_id', index_names)
+
+        #the migrated schema matches the models
+        inspector = inspect(db.engine)
+        created_at = [info for info in inspector.get_columns('posts') if info['name'] == 'created_at']
+        self.assertFalse(created_at[0]['nullable'])
+        for table in ['posts', 'post_tags']:
+            self.assertEqual({key['options'].get('ondelete') for key in inspector.get_foreign_keys(table)},
+                             {'CASCADE'})
+
+    def test_upgrade_baseline_database(self):
+        """Ensure a database with the original schema and data upgrades without losing rows"""
+
+        migrations.drop_all(db.engine)
+        with db.engine.begin() as conn:
+            migrations.create_tables(conn)
+            conn.execute(text("INSERT INTO users (id, first_name, last_name, image_url) "
+                              "VALUES (1, 'old', 'user', '')"))
+            conn.execute(text("INSERT INTO tags (id, name) VALUES (1, 'old')"))
+            conn.execute(text("INSERT INTO posts (id, title, content, user_id) "
+                              "VALUES (1, 'old post', 'content', 1)"))
+            conn.execute(text("INSERT INTO post_tags (tag_id, post_id) VALUES (1, 1), (1, 1)"))
+
+        migrations.upgrade(db.engine)
+        self.assertEqual(migrations.pending(db.engine), [])
+        post = Post.query.get(1)
+        self.assertIsNotNone(post.created_at)
+        self.assertEqual([tag.name for tag in post.tags], ['old'])
+        self.assertEqual(Tag.query.get(1).post_count, 1)
+        self.assertEqual(search.search_posts('old', 10).items[0].id, 1)
+
+        db.session.execute(User.__table__.delete())
         db.session.commit()
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual(PostTag.query.count(), 0)
+
+    def test_created_at_is_utc(self):
+        """Ensure posts inserted without created_at get the current UTC time"""
+
+        db.session.execute(Post.__table__.insert().values(title='raw', content='raw', user_id=1))
+        db.session.commit()
+        created_at = db.session.query(Post.created_at).filter_by(title='raw').scalar()
+        self.assertLess(abs(created_at - datetime.utcnow()), timedelta(minutes=1))
+
+    def test_created_at_without_server_default(self):
+        """Ensure new posts are stamped even where the column has no server default"""
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        self.client.post('/users/1/posts/new',
+                         data={'title': 'stamped', 'content': 'content', 'save_button': 'Add'})
+        insert = [statement for statement in statements if statement.startswith('INSERT INTO posts ')]
+        self.assertIn('created_at', insert[0])
 
     def test_user_list(self):
         """Ensure the users list has it's essential elements"""
@@ -25,7 +145,146 @@ class FlaskTests(TestCase):
             self.assertIn(b'<ul>', response.data)
             self.assertIn(b'<form action="/users/new">', response.data)
             self.assertIn(b'<input type="submit"', response.data)
-    
+
+    def test_user_list_pagination(self):
+        """Ensure the users list is split into pages linked by cursors"""
+
+        self.app.config['USERS_PER_PAGE'] = 2
+        for first, last in [('a', 'one'), ('b', 'two'), ('c', 'three')]:
+            db.session.add(User(first_name=first, last_name=last))
+        db.session.commit()
+
+        with self.client:
+            response = self.client.get('/users')
+            self.assertIn(b'a one', response.data)
+            self.assertIn(b'c three', response.data)
+            self.assertNotIn(b'b two', response.data)
+            self.assertNotIn(b'before=', response.data)
+
+            next_cursor = response.data.split(b'after=')[1].split(b'"')[0]
+            response = self.client.get('/users?after=' + next_cursor.decode())
+            self.assertIn(b'b two', response.data)
+            self.assertNotIn(b'a one', response.data)
+            self.assertIn(b'before=', response.data)
+            self.assertNotIn(b'after=', response.data)
+
+            response = self.client.get('/users?after=not-a-cursor')
+            self.assertEqual(response.status_code, 400)
+
+            #well formed cursors whose values do not fit the sort columns
+            for values in [[{}, 'a', 1], ['one', 'a', 'x'], ['one', 'a', 2 ** 64], ['one', 'a', None],
+                           ['one', 'a', True]]:
+                cursor = encode_cursor(values)
+                self.assertEqual(self.client.get('/users?after=' + cursor).status_code, 400)
+            for values in [[{}], ['1'], [2 ** 64], [None], [1.5]]:
+                cursor = encode_cursor(values)
+                self.assertEqual(self.client.get('/api/v1/users?after=' + cursor).status_code, 400)
+            for values in [['x', 1], [1e400, 1], [0.5, 'x'], [0.5, [1]]]:
+                cursor = encode_cursor(values)
+                self.assertEqual(self.client.get('/search?q=test&after=' + cursor).status_code, 400)
+            self.assertEqual(self.client.get('/?after=' + encode_cursor(['yesterday', 1])).status_code,
+                             400)
+
+    def test_timeline_and_user_page(self):
+        """Ensure the home timeline and the user page list posts newest first, a page at a time"""
+
+        self.assertIsNotNone(Post.query.get(1).created_at)
+        self.app.config['TIMELINE_PER_PAGE'] = 1
+        self.app.config['USER_POSTS_PER_PAGE'] = 1
+        db.session.add(Post(title='newer post', content='content', user_id=1,
+                            created_at=datetime(2100, 1, 1)))
+        db.session.commit()
+
+        with self.client:
+            for url in ['/', '/users/1']:
+                response = self.client.get(url)
+                self.assertIn(b'newer post', response.data)
+                self.assertNotIn(b'test post', response.data)
+
+                next_cursor = response.data.split(b'after=')[1].split(b'"')[0]
+                response = self.client.get(url + '?after=' + next_cursor.decode())
+                self.assertIn(b'test post', response.data)
+                self.assertNotIn(b'newer post', response.data)
+                self.assertNotIn(b'after=', response.data)
+
+                self.assertEqual(self.client.get(url + '?after=not-a-cursor').status_code, 400)
+
+            self.assertIn(b'test user', self.client.get('/').data)
+
+    def test_read_replicas(self):
+        """Ensure read_only views read from a replica, except right after the client wrote"""
+
+        #sessions are scoped per thread, drop the one bound to the in-memory app
+        db.session.remove()
+        with tempfile.TemporaryDirectory() as directory:
+            class ReplicaConfig(TestingConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'primary.db')
+                SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + os.path.join(directory, 'replica.db')]
+
+            app = create_app(ReplicaConfig)
+            primary = db.get_engine(app)
+            replica = db.get_engine(app, bind='replica_0')
+            migrations.upgrade(primary)
+            migrations.upgrade(replica)
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(),
+                             {'first_name': 'replica', 'last_name': 'user', 'image_url': ''})
+
+            #each request gets its own app context, as it would when deployed
+            client = app.test_client()
+            with client:
+                response = client.get('/users')
+                self.assertIn(b'replica user', response.data)
+
+                client.post('/users/new', data={'first': 'primary', 'last': 'user', 'URL': ''})
+                self.assertGreater(session['read_primary_until'], 0)
+                response = client.get('/users')
+                self.assertIn(b'primary user', response.data)
+                self.assertNotIn(b'replica user', response.data)
+
+                with client.session_transaction() as client_session:
+                    client_session['read_primary_until'] = 0
+                response = client.get('/users/1')
+                self.assertIn(b'replica user', response.data)
+
+                #the tag index is loaded from the primary even though the view reads the replica
+                client.post('/tags/new', data={'name': 'fresh', 'add_button': 'Add'})
+                with client.session_transaction() as client_session:
+                    client_session['read_primary_until'] = 0
+                app.extensions['tag_index'] = TagIndex()
+                response = client.get('/tags/autocomplete?q=fr')
+                self.assertEqual([tag['name'] for tag in response.json['tags']], ['fresh'])
+
+            #another client reading the lagging replica right after a write must
+            #not leave its page in the cache for the writer
+            writer, reader = app.test_client(), app.test_client()
+            writer.post('/users/new', data={'first': 'second', 'last': 'user', 'URL': ''})
+            self.assertNotIn(b'second user', reader.get('/users').data)
+            self.assertIn(b'second user', writer.get('/users').data)
+            self.assertIn(b'second user', reader.get('/users').data)
+
+            with primary.connect() as conn:
+                self.assertEqual(conn.execute(select(User.first_name).order_by(User.id)).scalars().all(),
+                                 ['primary', 'second'])
+            migrations.drop_all(replica)
+            migrations.drop_all(primary)
+            primary.dispose()
+            replica.dispose()
+
+    def test_read_projections(self):
+        """Ensure list views read plain rows that the session does not track"""
+
+        page = queries.user_list_page(10)
+        self.assertEqual(page.items, [queries.UserRow(1, 'test', 'user')])
+        self.assertEqual(queries.user_posts_page(1, 10).items[0].title, 'test post')
+        self.assertEqual(queries.tag_list(), [queries.TagRow(1, 'test', 1)])
+        self.assertIsNone(queries.user_profile(999))
+
+        db.session.remove()
+        queries.user_profile(1)
+        queries.user_posts_page(1, 10)
+        self.assertEqual(len(db.session.identity_map), 0)
+
     def test_add_user(self):
         """test adding a user on the add_user.html page"""
 
@@ -79,7 +338,7 @@ class FlaskTests(TestCase):
         with self.client:
             response = self.client.get('/tags')
             self.assertIn(b'<ul>', response.data)
-            self.assertIn(b'<li><a href="/tags/1">test</a></li>', response.data)
+            self.assertIn(b'<li><a href="/tags/1">test</a> <span>1</span></li>', response.data)
             self.assertIn(b'<input type="submit" value="add tag">', response.data)
             self.assertIn(b'<input type="submit" value="return to users">', response.data)
 
@@ -101,7 +360,102 @@ class FlaskTests(TestCase):
             self.assertIn(b'<h1>Edit Post</h1>', response.data)
             self.assertIn(b'<label>Content</label>', response.data)
             self.assertIn(b'<input type="submit" name="edit_button" value="Edit"></input>', response.data)
-    
+
+    def test_post_tags(self):
+        """test that a post shows its tags and the edit form only lists the tags it has"""
+
+        with self.client:
+            user = User(first_name='tag', last_name='owner')
+            db.session.add(user)
+            db.session.commit()
+            post = Post(title='tagged', content='content', user_id=user.id)
+            used = Tag(name='used')
+            unused = Tag(name='unused')
+            db.session.add_all([post, used, unused])
+            db.session.commit()
+            db.session.add(PostTag(post_id=post.id, tag_id=used.id))
+            db.session.commit()
+
+            response = self.client.get('/posts/' + str(post.id))
+            self.assertIn(b'<li>used</li>', response.data)
+            self.assertNotIn(b'<li>unused</li>', response.data)
+
+            response = self.client.get('/posts/' + str(post.id) + '/edit')
+            self.assertIn(('name="tag" value="' + str(used.id) + '" checked').encode(), response.data)
+            self.assertNotIn(b'unused', response.data)
+
+    def test_tag_autocomplete(self):
+        """test tag name completion from the in-memory index and from the database"""
+
+        db.session.add_all([Tag(name=name) for name in ['Python', 'pytest', 'postgres', '100%']])
+        db.session.commit()
+
+        with self.client:
+            response = self.client.get('/tags/autocomplete?q=PY')
+            self.assertEqual([tag['name'] for tag in response.json['tags']], ['pytest', 'Python'])
+
+            self.client.post('/tags/new', data={'name': 'pyramid', 'add_button': 'Add'})
+            response = self.client.get('/tags/autocomplete?q=py')
+            self.assertEqual([tag['name'] for tag in response.json['tags']],
+                             ['pyramid', 'pytest', 'Python'])
+            self.assertEqual(self.client.get('/tags/autocomplete?q=').json['tags'], [])
+
+            #a tag another worker created shows up once the index looks again
+            db.session.add(Tag(name='pandas'))
+            db.session.commit()
+            self.assertEqual(self.client.get('/tags/autocomplete?q=pa').json['tags'], [])
+            self.app.config['TAG_INDEX_REFRESH_SECONDS'] = 0
+            response = self.client.get('/tags/autocomplete?q=pa')
+            self.assertEqual([tag['name'] for tag in response.json['tags']], ['pandas'])
+
+            #a tag whose lower id commits after a higher one is still picked up
+            db.session.add(Tag(id=1001, name='parsnip'))
+            db.session.commit()
+            self.client.get('/tags/autocomplete?q=pa')
+            db.session.add(Tag(id=1000, name='parrot'))
+            db.session.commit()
+            response = self.client.get('/tags/autocomplete?q=par')
+            self.assertEqual([tag['name'] for tag in response.json['tags']], ['parrot', 'parsnip'])
+
+            #beyond the trailing window, the periodic full reload finds it
+            self.app.config['TAG_INDEX_TRAILING_IDS'] = 10
+            db.session.add(Tag(id=10, name='papaya'))
+            db.session.commit()
+            self.assertEqual(self.client.get('/tags/autocomplete?q=pap').json['tags'], [])
+            self.app.config['TAG_INDEX_RELOAD_SECONDS'] = 0
+            response = self.client.get('/tags/autocomplete?q=pap')
+            self.assertEqual([tag['name'] for tag in response.json['tags']], ['papaya'])
+
+            del self.app.extensions['tag_index']
+            response = self.client.get('/tags/autocomplete?q=py')
+            self.assertEqual([tag['name'] for tag in response.json['tags']],
+                             ['pyramid', 'pytest', 'Python'])
+            response = self.client.get('/tags/autocomplete?q=100%25')
+            self.assertEqual([tag['name'] for tag in response.json['tags']], ['100%'])
+            self.assertEqual(self.client.get('/tags/autocomplete?q=1_').json['tags'], [])
+
+    def test_sync_post_tags(self):
+        """test that saving a post only adds and removes the tags that changed"""
+
+        with self.client:
+            user = User(first_name='sync', last_name='user')
+            first = Tag(name='first')
+            second = Tag(name='second')
+            db.session.add_all([user, first, second])
+            db.session.commit()
+
+            self.client.post('/users/' + str(user.id) + '/posts/new',
+                             data={'title': 'synced', 'content': 'content',
+                                   'save_button': 'Add', 'tag': str(first.id)})
+            post = Post.query.filter_by(title='synced').one()
+            self.assertEqual([tag.id for tag in post.tags], [first.id])
+
+            self.client.post('/posts/' + str(post.id) + '/edit',
+                             data={'title': 'synced', 'content': 'content',
+                                   'edit_button': 'Edit', 'tag': [str(second.id), '99999']})
+            db.session.expire_all()
+            self.assertEqual([tag.id for tag in post.tags], [second.id])
+
     def test_delete_post(self):
         """test deleting a post"""
 
@@ -115,4 +469,523 @@ class FlaskTests(TestCase):
 
         with self.client:
             self.client.get('users/1/delete')
-            self.assertIsNone(session.get('test edited'))
\ No newline at end of file
+            self.assertIsNone(session.get('test edited'))
+
+    def test_batched_user_delete(self):
+        """test that a prolific user is deleted in batches on the background worker"""
+
+        self.app.config['DELETE_BATCH_SIZE'] = 2
+        for n in range(4):
+            self.client.post('/users/1/posts/new',
+                             data={'title': 'doomed %d' % n, 'content': 'doomed content',
+                                   'save_button': 'Add', 'tag': '1'})
+        self.assertEqual(Tag.query.get(1).post_count, 5)
+
+        #the eager testing queue would hide whether the request waited for the job
+        self.app.extensions['tasks'] = TaskQueue(self.app)
+        self.client.get('/users/1/delete')
+        self.app.extensions['tasks'].join()
+
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(1))
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual(PostTag.query.count(), 0)
+        self.assertEqual(Tag.query.get(1).post_count, 0)
+        self.assertEqual(search.search_posts('doomed', 10).items, [])
+
+    def test_interrupted_user_delete(self):
+        """test that a user whose purge was lost stays hidden until `flask blogly purge` finishes it"""
+
+        self.app.config['DELETE_BATCH_SIZE'] = 1
+        self.client.post('/users/1/posts/new',
+                         data={'title': 'doomed', 'content': 'doomed content', 'save_button': 'Add'})
+
+        class LostQueue:
+            def submit(self, func, *args):
+                pass
+
+        self.app.extensions['tasks'] = LostQueue()
+        self.client.get('/users/1/delete')
+        db.session.expire_all()
+        self.assertIsNotNone(User.query.get(1).deleted_at)
+        self.assertNotIn(b'test user', self.client.get('/users').data)
+        self.assertEqual(self.client.get('/users/1').status_code, 404)
+        self.assertEqual(self.client.get('/users/1/feed.xml').status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/users/1').status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/users').json['users'], [])
+
+        result = self.app.test_cli_runner().invoke(args=['blogly', 'purge'])
+        self.assertIn('purged user 1', result.output)
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(1))
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual(Tag.query.get(1).post_count, 0)
+        result = self.app.test_cli_runner().invoke(args=['blogly', 'purge'])
+        self.assertIn('no interrupted purges', result.output)
+
+    def test_cascading_deletes(self):
+        """test that deleting a user or post row removes what depends on it in the database"""
+
+        db.session.execute(Post.__table__.delete())
+        self.assertEqual(PostTag.query.count(), 0)
+
+        db.session.add(Post(title='orphan to be', content='content', user_id=1))
+        db.session.commit()
+        db.session.execute(User.__table__.delete())
+        db.session.commit()
+        self.assertEqual(Post.query.count(), 0)
+
+    def test_page_cache(self):
+        """test that read pages are cached, revalidated with ETags and invalidated by writes"""
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        with self.client:
+            response = self.client.get('/users')
+            etag = response.headers['ETag']
+            self.assertIn(b'test user', response.data)
+
+            del statements[:]
+            response = self.client.get('/users', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get('/users')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(statements, [])
+
+            self.client.post('/users/new', data={'first': 'cached', 'last': 'out', 'URL': ''})
+            response = self.client.get('/users', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'cached out', response.data)
+
+            self.assertIn(b'test post', self.client.get('/users/1').data)
+            self.client.post('/posts/1/edit', data={'title': 'renamed post', 'content': 'content',
+                                                    'edit_button': 'Edit', 'tag': '1'})
+            response = self.client.get('/users/1')
+            self.assertIn(b'renamed post', response.data)
+
+            #query arguments the view ignores do not make new entries
+            cache = self.app.extensions['page_cache']
+            self.assertIsNone(cache.shared)
+            entries = len(cache.local.entries)
+            for n in range(5):
+                self.client.get('/users?junk=%d' % n)
+            self.assertEqual(len(cache.local.entries), entries)
+
+    def test_page_cache_shared_backend(self):
+        """test that invalidating through one worker's cache reaches another sharing its backend"""
+
+        shared = MemoryBackend()
+        first = PageCache(10, shared)
+        second = PageCache(10, shared)
+
+        page = CachedPage(b'page', 'text/html', 'etag', None)
+        key = second.key_for('/users/1', ['user:1'])
+        second.set(key, page)
+        self.assertEqual(first.get(first.key_for('/users/1', ['user:1'])), page)
+
+        first.invalidate('user:1')
+        self.assertIsNone(second.get(second.key_for('/users/1', ['user:1'])))
+
+    def test_page_cache_ttl(self):
+        """test that cached pages expire and production needs a shared backend"""
+
+        cache = PageCache(10, ttl=60)
+        cache.set('page:/users|', CachedPage(b'page', 'text/html', 'etag', None))
+        self.assertEqual(cache.get('page:/users|').body, b'page')
+
+        cache = PageCache(10, ttl=-1)
+        cache.set('page:/users|', CachedPage(b'page', 'text/html', 'etag', None))
+        self.assertIsNone(cache.get('page:/users|'))
+        self.assertIsNone(cache.local.get('page:/users|'))
+
+        class Production(ProductionConfig):
+            SECRET_KEY = 'test'
+            PAGE_CACHE_ENABLED = True
+
+        with self.assertRaises(RuntimeError):
+            create_app(Production)
+        Production.PAGE_CACHE_BACKEND = MemoryBackend()
+        self.assertIn('page_cache', create_app(Production).extensions)
+
+    def test_search(self):
+        """test that posts are searchable by title and content as they are written"""
+
+        with self.client:
+            self.app.config['SEARCH_PER_PAGE'] = 1
+            self.client.post('/users/1/posts/new',
+                             data={'title': 'Volcano notes', 'content': 'lava everywhere',
+                                   'save_button': 'Add'})
+            self.client.post('/users/1/posts/new',
+                             data={'title': 'Gardening', 'content': 'a volcano of weeds',
+                                   'save_button': 'Add'})
+
+            response = self.client.get('/search?q=volcano')
+            self.assertIn(b'Volcano notes', response.data)
+            self.assertNotIn(b'Gardening', response.data)
+
+            next_cursor = response.data.split(b'after=')[1].split(b'"')[0]
+            response = self.client.get('/search?q=volcano&after=' + next_cursor.decode())
+            self.assertIn(b'Gardening', response.data)
+            self.assertNotIn(b'after=', response.data)
+
+            post = Post.query.filter_by(title='Gardening').one()
+            self.client.post('/posts/' + str(post.id) + '/edit',
+                             data={'title': 'Gardening', 'content': 'only weeds',
+                                   'edit_button': 'Edit'})
+            self.client.get('/posts/' + str(post.id) + '/delete')
+            response = self.client.get('/search?q=volcano')
+            self.assertIn(b'Volcano notes', response.data)
+            self.assertNotIn(b'after=', response.data)
+            response = self.client.get('/search?q=weeds')
+            self.assertNotIn(b'Gardening', response.data)
+
+    def test_tag_posts_and_counts(self):
+        """test that a tag page pages through its posts and tag counts follow post writes"""
+
+        with self.client:
+            self.app.config['TAG_POSTS_PER_PAGE'] = 1
+            self.client.post('/users/1/posts/new',
+                             data={'title': 'second post', 'content': 'content',
+                                   'save_button': 'Add', 'tag': '1'})
+            self.assertEqual(Tag.query.get(1).post_count, 2)
+
+            response = self.client.get('/tags/1')
+            self.assertIn(b'2 posts', response.data)
+            self.assertIn(b'second post', response.data)
+            self.assertNotIn(b'test post', response.data)
+
+            next_cursor = response.data.split(b'after=')[1].split(b'"')[0]
+            response = self.client.get('/tags/1?after=' + next_cursor.decode())
+            self.assertIn(b'test post', response.data)
+            self.assertNotIn(b'after=', response.data)
+
+            self.client.post('/posts/1/edit', data={'title': 'test post', 'content': 'content',
+                                                    'edit_button': 'Edit'})
+            db.session.expire_all()
+            self.assertEqual(Tag.query.get(1).post_count, 1)
+            self.assertIn(b'<span>1</span>', self.client.get('/tags').data)
+
+            post = Post.query.filter_by(title='second post').one()
+            self.client.get('/posts/' + str(post.id) + '/delete')
+            db.session.expire_all()
+            self.assertEqual(Tag.query.get(1).post_count, 0)
+            self.assertIn(b'<span>0</span>', self.client.get('/tags').data)
+            self.assertIn(b'0 posts', self.client.get('/tags/1').data)
+
+    def test_feeds(self):
+        """test that feeds are served from the cache, revalidated and rebuilt after post writes"""
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        with self.client:
+            urls = ['/users/1/feed.xml', '/tags/1/feed.xml']
+            etags = {}
+            for url in urls:
+                response = self.client.get(url)
+                self.assertEqual(response.mimetype, 'application/atom+xml')
+                self.assertIn(b'<title>test post</title>', response.data)
+                self.assertIn(b'<name>test user</name>', response.data)
+                #nothing has invalidated the feed yet, so its change time is unknown
+                self.assertNotIn('Last-Modified', response.headers)
+                etags[url] = response.headers['ETag']
+
+                del statements[:]
+                response = self.client.get(url, headers={'If-None-Match': etags[url]})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(statements, [])
+
+            self.client.post('/posts/1/edit', data={'title': 'retitled', 'content': 'content',
+                                                    'edit_button': 'Edit', 'tag': '1'})
+            #make the edit an hour old, so the next one moves Last-Modified
+            counters = self.app.extensions['page_cache'].counters
+            for dep in ['user:1', 'tag:1']:
+                counters.set('changed:' + dep, counters.get('changed:' + dep) - 3600)
+            last_modified = {}
+            for url in urls:
+                response = self.client.get(url, headers={'If-None-Match': etags[url]})
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(b'<title>retitled</title>', response.data)
+                last_modified[url] = response.headers['Last-Modified']
+                response = self.client.get(url, headers={'If-Modified-Since': last_modified[url]})
+                self.assertEqual(response.status_code, 304)
+
+            self.client.post('/posts/1/edit', data={'title': 'edited again', 'content': 'content',
+                                                    'edit_button': 'Edit', 'tag': '1'})
+            for url in urls:
+                response = self.client.get(url, headers={'If-Modified-Since': last_modified[url]})
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(b'<title>edited again</title>', response.data)
+
+            self.client.post('/users/1/edit', data={'first': 'renamed', 'last': 'author',
+                                                    'URL': 'https://example.com/a.png',
+                                                    'save_button': 'Save'})
+            self.assertIn(b'<name>renamed author</name>', self.client.get('/tags/1/feed.xml').data)
+            self.client.patch('/api/v1/users', json={'id': 1, 'last_name': 'again'})
+            self.assertIn(b'<name>renamed again</name>', self.client.get('/tags/1/feed.xml').data)
+
+            self.assertEqual(self.client.get('/tags/99/feed.xml').status_code, 404)
+
+        #without the page cache feeds still carry an ETag and answer conditional requests
+        del self.app.extensions['page_cache']
+        response = self.client.get('/users/1/feed.xml')
+        response = self.client.get('/users/1/feed.xml', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_api(self):
+        """test the JSON API's batch writes, cursor pagination and field selection"""
+
+        with self.client:
+            response = self.client.post('/api/v1/users', json=[
+                {'first_name': 'api', 'last_name': 'one'},
+                {'first_name': 'api', 'last_name': 'two', 'image_url': 'https://example.com/a.png'}])
+            self.assertEqual(response.status_code, 201)
+            users = response.json['users']
+            self.assertEqual([user['last_name'] for user in users], ['one', 'two'])
+            self.assertEqual(users[0]['image_url'], 'https://bit.ly/3y8O4Be')
+
+            response = self.client.post('/api/v1/tags', json={'name': 'api'})
+            self.assertEqual(response.status_code, 201)
+            tag_id = response.json['id']
+            self.assertEqual(self.client.post('/api/v1/tags', json={'name': 'api'}).status_code, 409)
+
+            response = self.client.post('/api/v1/posts', json=[
+                {'title': 'api post %d' % n, 'content': 'bulk loaded', 'user_id': users[0]['id'],
+                 'tags': [1, tag_id]} for n in range(3)])
+            self.assertEqual(response.status_code, 201)
+            posts = response.json['posts']
+            self.assertEqual(posts[0]['tags'], [1, tag_id])
+            self.assertIsNotNone(posts[0]['created_at'])
+            self.assertEqual(Tag.query.get(tag_id).post_count, 3)
+            self.assertEqual(len(search.search_posts('bulk', 10).items), 3)
+            self.assertIn(b'api post 2', self.client.get('/users/%d' % users[0]['id']).data)
+
+            self.assertIn(b'api post 0', self.client.get('/tags/1').data)
+            response = self.client.patch('/api/v1/posts', json=[
+                {'id': posts[0]['id'], 'title': 'patched', 'tags': [1]},
+                {'id': posts[1]['id'], 'content': 'rewritten'}])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['posts'][0]['tags'], [1])
+            self.assertEqual(response.json['posts'][1]['content'], 'rewritten')
+            db.session.expire_all()
+            self.assertEqual(Tag.query.get(tag_id).post_count, 2)
+            self.assertIn(b'patched', self.client.get('/tags/1').data)
+
+            for image_url in [{}, 5, '']:
+                response = self.client.post('/api/v1/users', json={'first_name': 'bad', 'last_name': 'url',
+                                                                   'image_url': image_url})
+                self.assertEqual(response.status_code, 400)
+
+            response = self.client.patch('/api/v1/users', json={'id': users[1]['id'], 'first_name': 'renamed'})
+            self.assertEqual(response.json['first_name'], 'renamed')
+            self.assertEqual(self.client.patch('/api/v1/users', json={'id': 999, 'first_name': 'x'})
+                             .status_code, 404)
+
+            response = self.client.get('/api/v1/posts?limit=2&fields=title')
+            self.assertEqual(response.json['posts'], [{'title': 'test post'}, {'title': 'patched'}])
+            response = self.client.get('/api/v1/posts?limit=2&fields=id,tags&after=' + response.json['next'])
+            self.assertEqual([post['id'] for post in response.json['posts']],
+                             [posts[1]['id'], posts[2]['id']])
+            self.assertIsNone(response.json['next'])
+            self.assertEqual(self.client.get('/api/v1/users/1?fields=first_name').json,
+                             {'first_name': 'test'})
+
+            self.assertEqual(self.client.get('/api/v1/posts?fields=password').status_code, 400)
+            self.assertEqual(self.client.get('/api/v1/posts?after=nonsense').status_code, 400)
+            response = self.client.post('/api/v1/posts', json=[{'title': 'no user', 'content': 'x'}])
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json)
+            self.assertEqual(self.client.post('/api/v1/posts', json={
+                'title': 't', 'content': 'c', 'user_id': 1, 'tags': [12345]}).status_code, 404)
+
+            #retagging a batch costs the same statements whatever its size
+            statements = []
+            record = lambda *args: statements.append(args[2])
+            event.listen(db.engine, 'before_cursor_execute', record)
+            counts = []
+            for size in (2, 20):
+                response = self.client.post('/api/v1/posts', json=[
+                    {'title': 'batch', 'content': 'c', 'user_id': 1, 'tags': [1]}] * size)
+                batch = [{'id': post['id'], 'tags': [tag_id]} for post in response.json['posts']]
+                del statements[:]
+                self.client.patch('/api/v1/posts', json=batch)
+                counts.append(len(statements))
+            event.remove(db.engine, 'before_cursor_execute', record)
+            self.assertEqual(counts[0], counts[1])
+            db.session.expire_all()
+            self.assertEqual(Tag.query.get(tag_id).post_count, 24)
+
+    def test_avatars(self):
+        """test that avatars are fetched once, cached on disk, evicted and refreshed on edit"""
+
+        fetched = []
+        def fetch(url):
+            fetched.append(url)
+            self.assertFalse(db.session().in_transaction())
+            if url.endswith('.txt'):
+                raise ValueError('not found')
+            return benchmark.AVATAR
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.app.config['AVATAR_FETCHER'] = fetch
+        self.app.extensions['avatars'] = AvatarStore(directory.name, 1024 * 1024)
+
+        with self.client:
+            link = self.client.get('/users/1').data.split(b'src="')[1].split(b'"')[0].decode()
+            self.assertEqual(link, '/avatars/1?v=' + avatar_version('https://bit.ly/3y8O4Be'))
+
+            response = self.client.get(link)
+            self.assertEqual((response.data, response.mimetype),
+                             thumbnail(benchmark.AVATAR, self.app.config['AVATAR_SIZES'][-1]))
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            etag = response.headers['ETag']
+
+            statements = []
+            event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+            response = self.client.get(link, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(statements, [])
+            self.assertEqual(self.client.get('/avatars/1').headers['Cache-Control'], 'no-cache')
+            self.assertEqual(fetched, ['https://bit.ly/3y8O4Be'])
+            self.assertEqual(self.client.get('/avatars/1?size=7').status_code, 400)
+            self.assertEqual(self.client.get('/avatars/1?v=../../../etc/passwd').status_code, 400)
+            self.assertEqual(self.client.get('/avatars/1?v=ABCDEF0123456789').status_code, 400)
+
+            self.client.post('/users/1/edit', data={'first': 'test', 'last': 'user',
+                                                    'URL': 'https://example.com/new.png',
+                                                    'save_button': 'Save'})
+            #other users may share the old url, so its thumbnails stay cached
+            response = self.client.get(link)
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertEqual(fetched, ['https://bit.ly/3y8O4Be'])
+            self.assertEqual(self.client.get('/avatars/1').headers['Cache-Control'], 'no-cache')
+            self.assertEqual(fetched[-1], 'https://example.com/new.png')
+            self.assertIn(avatar_version('https://example.com/new.png').encode(),
+                          self.client.get('/users/1').data)
+
+            self.client.post('/users/1/edit', data={'first': 'test', 'last': 'user',
+                                                    'URL': 'https://example.com/missing.txt',
+                                                    'save_button': 'Save'})
+            self.assertEqual(self.client.get('/avatars/1').status_code, 404)
+
+        store = AvatarStore(directory.name, 0)
+        store.put('old', 64, b'old', 'image/png')
+        self.assertIsNone(store.get('old', 64))
+
+        #the blob tree is walked on the first write and when the cache overflows, not on every miss
+        store = AvatarStore(tempfile.mkdtemp(dir=directory.name), 100)
+        walks = []
+        blobs = store._blobs
+        store._blobs = lambda: walks.append(1) or blobs()
+        for n in range(12):
+            store.put('v%d' % n, 64, b'%09d' % n, 'image/png')
+        self.assertEqual(len(walks), 2)
+        self.assertEqual(store.total, 90)
+
+        for url in ['file:///etc/passwd', 'ftp://example.com/a.png', 'http://127.0.0.1/a.png',
+                    'http://10.0.0.1/a.png', 'http://169.254.169.254/latest/meta-data',
+                    'http://[::1]/a.png', 'http://[::ffff:127.0.0.1]/a.png', 'http://0.0.0.0/']:
+            with self.assertRaises(ValueError):
+                fetch_url(url)
+
+    @skipIf(Image is None, 'Pillow is not installed')
+    def test_avatar_thumbnail(self):
+        """test that Pillow crops and scales an image to a square JPEG"""
+
+        source = io.BytesIO()
+        Image.new('RGB', (200, 100), 'red').save(source, 'PNG')
+        data, content_type = thumbnail(source.getvalue(), 64)
+        self.assertEqual(content_type, 'image/jpeg')
+        with Image.open(io.BytesIO(data)) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (64, 64)))
+        with self.assertRaises(ValueError):
+            thumbnail(b'not an image', 64)
+
+    def test_avatar_fetch_pins_address(self):
+        """test that a host resolving to a public address for the check cannot be fetched from a private one"""
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), http.server.SimpleHTTPRequestHandler)
+        self.addCleanup(server.server_close)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+
+        #the first lookup of the host answers a public address, later ones the local server
+        lookups = []
+        getaddrinfo = socket.getaddrinfo
+        def rebinding(host, port, *args, **kwargs):
+            if host != 'rebind.example':
+                return getaddrinfo(host, port, *args, **kwargs)
+            lookups.append(host)
+            address = '93.184.216.34' if len(lookups) == 1 else '127.0.0.1'
+            return getaddrinfo(address, port, *args, **kwargs)
+        socket.getaddrinfo = rebinding
+        self.addCleanup(setattr, socket, 'getaddrinfo', getaddrinfo)
+
+        with self.app.app_context():
+            with self.assertRaisesRegex(ValueError, 'non-public'):
+                fetch_url('http://rebind.example:%d/' % server.server_port)
+        self.assertEqual(len(lookups), 2)
+
+    def test_export_import(self):
+        """test that an NDJSON dump and a CSV table dump load into an empty database"""
+
+        self.client.post('/users/1/posts/new',
+                         data={'title': 'exported', 'content': 'streamed out',
+                               'save_button': 'Add', 'tag': '1'})
+        runner = self.app.test_cli_runner()
+        dump = runner.invoke(args=['blogly', 'export']).stdout
+        users_csv = runner.invoke(args=['blogly', 'export', '--format', 'csv', '--table', 'users']).stdout
+        self.assertEqual(len(dump.splitlines()), 4)
+        self.assertIn('"tags": ["test"]', dump)
+
+        other = create_app('testing')
+        with other.app_context():
+            migrations.upgrade(db.engine)
+            runner = other.test_cli_runner()
+
+            result = runner.invoke(args=['blogly', 'import', '--format', 'csv', '--table', 'users'],
+                                   input=users_csv)
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(User.query.get(1).first_name, 'test')
+
+            posts_only = '\n'.join(line for line in dump.splitlines() if '"type": "user"' not in line)
+            result = runner.invoke(args=['blogly', 'import', '--batch-size', '1'], input=posts_only)
+            self.assertEqual(result.exit_code, 0, result.output)
+
+            post = Post.query.filter_by(title='exported').one()
+            self.assertEqual([tag.name for tag in post.tags], ['test'])
+            self.assertEqual(Tag.query.filter_by(name='test').one().post_count, 2)
+            self.assertIn(b'exported', other.test_client().get('/search?q=streamed').data)
+            db.session.remove()
+
+    def test_query_budgets(self):
+        """test that no route issues more SQL statements than its benchmark budget"""
+
+        report = benchmark.benchmark('sqlite://', users=20, posts=100, tags=10,
+                                     tags_per_post=3, iterations=2)
+        self.assertEqual(report['uncovered_endpoints'], [])
+        for route in report['routes']:
+            self.assertLessEqual(route['statements'], route['budget'],
+                                 '%s %s' % (route['method'], route['url']))
+
+    def test_metrics(self):
+        """test that requests report Server-Timing and feed the /metrics histograms"""
+
+        with self.client:
+            self.app.extensions['metrics'].slow_query_seconds = 0
+            response = self.client.get('/users/1')
+            self.assertIn('db;dur=', response.headers['Server-Timing'])
+            self.assertIn('desc="2 queries"', response.headers['Server-Timing'])
+            self.assertIn('tpl;dur=', response.headers['Server-Timing'])
+            self.assertIn('blogly.user_page', [entry[0] for entry in
+                                               self.app.extensions['metrics'].slow_queries])
+
+            response = self.client.get('/metrics')
+            self.assertIn(b'# TYPE blogly_request_duration_seconds histogram', response.data)
+            self.assertIn(b'blogly_request_duration_seconds_count{endpoint="blogly.user_page"} 1',
+                          response.data)
+            self.assertIn(b'blogly_sql_statements_total{endpoint="blogly.user_page"} 2', response.data)
+            self.assertIn(b'blogly_template_duration_seconds_bucket{endpoint="blogly.user_page",le="+Inf"} 1',
+                          response.data)
@@ -0,0 +1,268 @@
+"""Streaming bulk export and import of users, tags and posts.
+
+NDJSON dumps hold one object per line tagged with its "type", written in the
+order users, tags, posts so a dump can be loaded front to back. Posts carry
+their tags by name. CSV dumps hold a single table with a header row and map
+directly onto PostgreSQL COPY.
+
+Exports read through server-side cursors and imports write in fixed size
+batches, each in its own transaction, so memory use does not grow with the
+size of the dataset.
+"""
+import csv
+import json
+from collections import Counter, defaultdict
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import bindparam, select, text
+
+from models import default_url, Post, PostTag, Tag, User
+import search
+
+users = User.__table__
+tags = Tag.__table__
+posts = Post.__table__
+post_tags = PostTag.__table__
+
+#columns written to and read from CSV dumps; derived columns such as
+#tags.post_count are rebuilt after an import instead
+TABLES = {
+    'users': (users, ['id', 'first_name', 'last_name', 'image_url']),
+    'tags': (tags, ['id', 'name']),
+    'posts': (posts, ['id', 'title', 'content', 'created_at', 'user_id']),
+    'post_tags': (post_tags, ['post_id', 'tag_id']),
+}
+
+def _partitions(conn, statement, batch_size):
+    """yield lists of row mappings from a server-side cursor over statement"""
+
+    result = conn.execution_options(stream_results=True).execute(statement)
+    return result.mappings().partitions(batch_size)
+
+def _chunks(iterable, size):
+    """yield lists of up to size items from iterable"""
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _jsonable(row):
+    return {key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in row.items()}
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+def _fill_created_at(rows):
+    """stamp posts that arrive without a created_at
+
+    a batch where every post lacks one leaves the column out so the column
+    default applies; in a mixed batch the gaps get the current UTC time.
+    """
+
+    if all(row.get('created_at') is None for row in rows):
+        for row in rows:
+            row.pop('created_at', None)
+        return
+    now = datetime.utcnow()
+    for row in rows:
+        if row['created_at'] is None:
+            row['created_at'] = now
+
+def export_ndjson(conn, out, batch_size=1000):
+    """write every user, tag and post to out as NDJSON; returns the number of records"""
+
+    written = 0
+    for kind, table in (('user', 'users'), ('tag', 'tags')):
+        table, columns = TABLES[table]
+        statement = select(*[table.c[column] for column in columns]).order_by(table.c.id)
+        for partition in _partitions(conn, statement, batch_size):
+            for row in partition:
+                out.write(json.dumps(dict(_jsonable(row), type=kind)) + '\n')
+            written += len(partition)
+
+    _, columns = TABLES['posts']
+    statement = select(*[posts.c[column] for column in columns]).order_by(posts.c.id)
+    for partition in _partitions(conn, statement, batch_size):
+        #one query resolves the tag names of the whole batch of posts
+        names = defaultdict(list)
+        links = (select(post_tags.c.post_id, tags.c.name)
+                 .join(tags, tags.c.id == post_tags.c.tag_id)
+                 .where(post_tags.c.post_id.in_([row['id'] for row in partition]))
+                 .order_by(tags.c.name))
+        for post_id, name in conn.execute(links):
+            names[post_id].append(name)
+
+        for row in partition:
+            record = dict(_jsonable(row), type='post', tags=names[row['id']])
+            out.write(json.dumps(record) + '\n')
+        written += len(partition)
+
+    return written
+
+def export_csv(conn, table_name, out, batch_size=1000):
+    """write one table to out as CSV with a header row; returns the number of rows"""
+
+    table, columns = TABLES[table_name]
+    #id for most tables, (post_id, tag_id) for post_tags
+    order = [table.c[column] for column in columns[:2]]
+    statement = select(*[table.c[column] for column in columns]).order_by(*order)
+
+    if conn.dialect.name == 'postgresql':
+        sql = str(statement.compile(dialect=conn.dialect))
+        cursor = conn.connection.cursor()
+        cursor.copy_expert('COPY (%s) TO STDOUT WITH CSV HEADER' % sql, out)
+        return cursor.rowcount
+
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    written = 0
+    for partition in _partitions(conn, statement, batch_size):
+        writer.writerows([row[column] for column in columns] for row in partition)
+        written += len(partition)
+    return written
+
+def _insert_users(conn, records):
+    rows = [{'id': record.get('id'),
+             'first_name': record['first_name'],
+             'last_name': record['last_name'],
+             'image_url': record.get('image_url') or default_url}
+            for record in records]
+    if all(row['id'] is None for row in rows):
+        for row in rows:
+            del row['id']
+    conn.execute(users.insert(), rows)
+
+def _insert_tags(conn, records):
+    rows = [{'id': record.get('id'), 'name': record['name']} for record in records]
+    if all(row['id'] is None for row in rows):
+        for row in rows:
+            del row['id']
+    conn.execute(tags.insert(), rows)
+
+def _resolve_tag_names(conn, names):
+    """return a name to id mapping for names, creating the tags that do not exist yet"""
+
+    if not names:
+        return {}
+    ids = dict(conn.execute(select(tags.c.name, tags.c.id).where(tags.c.name.in_(names))).fetchall())
+    missing = names - ids.keys()
+    if missing:
+        conn.execute(tags.insert(), [{'name': name} for name in sorted(missing)])
+        ids.update(conn.execute(select(tags.c.name, tags.c.id).where(tags.c.name.in_(missing))).fetchall())
+    return ids
+
+def _insert_posts(conn, records):
+    if any(record.get('id') is None for record in records):
+        raise ValueError('every imported post needs an id so its tags can be linked')
+
+    rows = [{'id': record['id'],
+             'title': record['title'],
+             'content': record['content'],
+             'created_at': _parse_datetime(record.get('created_at')),
+             'user_id': record.get('user_id')}
+            for record in records]
+    _fill_created_at(rows)
+    conn.execute(posts.insert(), rows)
+
+    tag_ids = _resolve_tag_names(conn, {name for record in records
+                                        for name in record.get('tags', [])})
+    links = [{'post_id': record['id'], 'tag_id': tag_ids[name]}
+             for record in records for name in set(record.get('tags', []))]
+    if links:
+        conn.execute(post_tags.insert(), links)
+        counts = Counter(link['tag_id'] for link in links)
+        conn.execute(tags.update()
+                     .where(tags.c.id == bindparam('tag_id'))
+                     .values(post_count=tags.c.post_count + bindparam('added')),
+                     [{'tag_id': tag_id, 'added': added} for tag_id, added in counts.items()])
+
+    search.index_posts([record['id'] for record in records], conn)
+
+INSERTERS = {'user': _insert_users, 'tag': _insert_tags, 'post': _insert_posts}
+
+def _reset_sequences(conn):
+    """move PostgreSQL id sequences past the ids an import wrote explicitly"""
+
+    if conn.dialect.name != 'postgresql':
+        return
+    for table in ('users', 'tags', 'posts', 'post_tags'):
+        conn.execute(text("SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                          "(SELECT coalesce(max(id), 0) + 1 FROM %s), false)" % (table, table)))
+
+def import_ndjson(engine, lines, batch_size=1000):
+    """load an NDJSON dump written by export_ndjson; returns the number of records"""
+
+    def batches():
+        batch = []
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get('type') not in INSERTERS:
+                raise ValueError('unknown record type %r' % record.get('type'))
+            if batch and (record['type'] != batch[0]['type'] or len(batch) >= batch_size):
+                yield batch
+                batch = []
+            batch.append(record)
+        if batch:
+            yield batch
+
+    loaded = 0
+    for batch in batches():
+        with engine.begin() as conn:
+            INSERTERS[batch[0]['type']](conn, batch)
+        loaded += len(batch)
+
+    with engine.begin() as conn:
+        _reset_sequences(conn)
+    return loaded
+
+def _refresh_derived(conn, table_name):
+    """rebuild what a raw table load bypassed: tag post counts and the search index"""
+
+    if table_name == 'post_tags':
+        conn.execute(text('UPDATE tags SET post_count = '
+                          '(SELECT count(*) FROM post_tags WHERE post_tags.tag_id = tags.id)'))
+    if table_name == 'posts':
+        search.index_unindexed_posts(conn)
+    _reset_sequences(conn)
+
+def import_csv(engine, table_name, stream, batch_size=1000):
+    """load one table from a CSV dump with a header row; returns the number of rows"""
+
+    table, allowed = TABLES[table_name]
+    header = next(csv.reader([stream.readline()]), [])
+    if not header or set(header) - set(allowed):
+        raise ValueError('%s CSV columns must be drawn from %s' % (table_name, ', '.join(allowed)))
+
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as conn:
+            cursor = conn.connection.cursor()
+            cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (table_name, ', '.join(header)),
+                               stream)
+            loaded = cursor.rowcount
+            _refresh_derived(conn, table_name)
+        return loaded
+
+    loaded = 0
+    for chunk in _chunks(csv.reader(stream), batch_size):
+        rows = []
+        for values in chunk:
+            row = {column: value if value != '' else None for column, value in zip(header, values)}
+            if 'created_at' in row:
+                row['created_at'] = _parse_datetime(row['created_at'])
+            rows.append(row)
+        if 'created_at' in header:
+            _fill_created_at(rows)
+        with engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+        loaded += len(rows)
+
+    with engine.begin() as conn:
+        _refresh_derived(conn, table_name)
+    return loaded